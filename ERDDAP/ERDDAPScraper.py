@@ -1,24 +1,43 @@
+import csv
+import io
+import json
 import re
 import sys
 
-from datetime import date, datetime, timedelta
-from selenium import webdriver
+from datetime import date, datetime, timedelta, timezone
+from os import makedirs, replace
+from os.path import getmtime, isfile
+from time import time
+from urllib.parse import quote
 from urllib.request import urlopen
 
 class ERDDAPScraper:
-    def __init__(self, dataset_id, start, stop, latitude, longitude, step=30):
+    _server = 'https://coastwatch.pfeg.noaa.gov/erddap'
+
+    def __init__(self, dataset_id, start, stop, latitude, longitude, step=30, browser=False, cache_path='./.erddap_cache/', cache_ttl=86400):
         # set ERDDAP database by ID
         self.dataset_id = dataset_id
-        self.database = 'https://coastwatch.pfeg.noaa.gov/erddap/griddap/{}.html'.format(self.dataset_id)
+        self.database = '{}/griddap/{}.html'.format(self._server, self.dataset_id)
 
         # range of dates to be pulled
         self.start = self.validate_date(start) 
         self.stop = self.validate_date(stop)
 
-        # initialize scraper
-        self.driver = webdriver.PhantomJS()
-        self.driver.get(self.database)
-        self.generic_link = self.generate_generic_link()
+        # the browser only starts if the form has to be driven or pull_data is used
+        self._driver = None
+        self.cache_path = cache_path
+        # seconds before cached metadata is fetched again, None to keep it forever
+        self.cache_ttl = cache_ttl
+
+        if browser:
+            # the form always shows the current bounds
+            self.metadata_current = True
+            self.driver.get(self.database)
+            self.generic_link = self.generate_generic_link()
+
+        else:
+            self.generic_link = self.generate_metadata_link()
+            self.cover(self.stop)
 
         # coordinates
         self.latitude = latitude
@@ -27,6 +46,82 @@ class ERDDAPScraper:
         # number of days pulled at once
         self.step = step
 
+    @property
+    def driver(self):
+        if self._driver == None:
+            from selenium import webdriver
+            self._driver = webdriver.PhantomJS()
+
+        return self._driver
+
+    def load_metadata(self, refresh=False):
+        # parsed metadata is cached per dataset, so a warm start skips the request
+        filepath = '{}{}.json'.format(self.cache_path, self.dataset_id)
+
+        if not refresh and isfile(filepath) and (self.cache_ttl == None or time() - getmtime(filepath) < self.cache_ttl):
+            self.metadata_current = False
+
+            with open(filepath) as f:
+                return json.load(f)
+
+        self.metadata_current = True
+        link = '{}/info/{}/index.json'.format(self._server, self.dataset_id)
+        metadata = self.parse_metadata(json.load(urlopen(link)))
+
+        makedirs(self.cache_path, exist_ok=True)
+
+        with open(filepath + '.tmp', 'w') as f:
+            json.dump(metadata, f)
+
+        replace(filepath + '.tmp', filepath)
+
+        return metadata
+
+    def parse_metadata(self, info):
+        # rows are (row type, variable name, attribute name, data type, value)
+        axes = []
+        variables = []
+        time_range = None
+
+        for row_type, name, attribute, _, value in info['table']['rows']:
+            if row_type == 'dimension':
+                axes.append(name)
+
+            elif row_type == 'variable':
+                variables.append(name)
+
+            elif row_type == 'attribute' and name == 'time' and attribute == 'actual_range':
+                # seconds since 1970-01-01T00:00:00Z
+                time_range = [ datetime.fromtimestamp(float(bound), timezone.utc).strftime('%Y-%m-%d') for bound in value.split(',') ]
+
+        return {'axes': axes, 'variables': variables, 'time_range': time_range}
+
+    def generate_metadata_link(self, refresh=False):
+        metadata = self.load_metadata(refresh)
+
+        try:
+            self.lo = self.validate_date(metadata['time_range'][0])
+            self.hi = self.validate_date(metadata['time_range'][1])
+
+        except (TypeError, IndexError) as e:
+            print(e)
+            self.lo = self.validate_date('1970-1-1')
+            self.hi = self.validate_date('2020-1-1')
+
+        # same placeholders as the form: dates as {0} and {1}, latitude as {2}, longitude as {3}
+        constraints = {'time': '[({0}):1:({1})]', 'latitude': '[({2}):1:({2})]', 'longitude': '[({3}):1:({3})]'}
+        query = ''.join([ constraints.get(axis, '[0:1:0]') for axis in metadata['axes'] ])
+
+        # brackets are percent-encoded since newer servers reject them raw
+        query = quote(query, safe='(){}:.')
+
+        return '{}/griddap/{}.htmlTable?{}'.format(self._server, self.dataset_id, ','.join([ variable + query for variable in metadata['variables'] ]))
+
+    def cover(self, date):
+        # a date past a cached time range may only mean the dataset has grown since it was cached
+        if not self.metadata_current and date != None and self.hi != None and date > self.hi:
+            self.generic_link = self.generate_metadata_link(refresh=True)
+
     def find_date_bounds(self, date_entry):
         text = date_entry.get_attribute('onmouseover')
         bounds = re.findall('\d{4}-\d{2}-\d{2}T[01][0268]:00:00Z', text)
@@ -107,6 +202,27 @@ class ERDDAPScraper:
 
         return [ self.generic_link.format(dates[i], dates[i+1], self.latitude, self.longitude) for i in range(len(dates)-1) ]
 
+    def stream_rows(self, link):
+        # same query as the table, but as .csv so rows can be parsed while they arrive
+        response = urlopen(link.replace('.htmlTable?', '.csv?', 1))
+        reader = csv.reader(io.TextIOWrapper(response, encoding='utf-8', newline=''))
+
+        # first row holds the column names, second row their units
+        names = next(reader)
+        next(reader)
+
+        parsers = [ str if name == 'time' else self.parse_number for name in names ]
+
+        for row in reader:
+            yield tuple([ parse(value) for parse, value in zip(parsers, row) ])
+
+    def parse_number(self, value):
+        try:
+            return float(value)
+
+        except ValueError:
+            return value
+
     def validate_date(self, date):
         try:
             date = re.split('-|/', date[:10])
@@ -5,18 +5,23 @@ import re
 import sys
 
 from bs4 import BeautifulSoup
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+from itertools import chain
 from ERDDAPScraper import ERDDAPScraper
 from os import makedirs
 from os.path import isdir, isfile
+from threading import BoundedSemaphore
+from urllib.parse import urlparse
 from urllib.request import urlopen
 
 class SurveyScraper(ERDDAPScraper):
     _survey_name = 'COVAR_CSUCI_FINAL.xlsx'
     
-    def __init__(self, dataset_id, start=None, stop=None, latitude=None, longitude=None, step=30, path='./', coord_name='SITE_LAT_LONG_FINAL.xlsx'):
+    def __init__(self, dataset_id, start=None, stop=None, latitude=None, longitude=None, step=30, path='./', coord_name='SITE_LAT_LONG_FINAL.xlsx', browser=False, cache_ttl=86400):
         self._coord_name = coord_name
-        ERDDAPScraper.__init__(self, dataset_id, start, stop, latitude, longitude, step)
+        ERDDAPScraper.__init__(self, dataset_id, start, stop, latitude, longitude, step, browser, path + '.erddap_cache/', cache_ttl)
         # where the program will look for critical files and store generated files
         self.path = path
         # open critical files
@@ -43,6 +48,9 @@ class SurveyScraper(ERDDAPScraper):
             site_code = row[3].value
             start = row[5].value
             stop = row[6].value
+
+            # newer surveys than the cached range trigger one refetch instead of being dropped
+            self.cover(stop)
      
             if start < self.lo or start > self.hi:
                 continue
@@ -142,7 +150,37 @@ class SurveyScraper(ERDDAPScraper):
         print('{} files need to be completed.'.format(count))
         return count
 
-    def pull_site_data(self): 
+    def pull_site_data(self, workers=1, per_host=4):
+        # serial by default, one request at a time
+        if workers == 1:
+            for filepath, site_survey, links in self.plan_site_data():
+                for link in links:
+                    try:
+                        self.spull_data(link, site_survey, filepath)
+
+                    except:
+                        continue
+
+            return
+
+        # one semaphore per host caps its concurrent requests below the pool size
+        semaphores = {}
+        pending = deque()
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for filepath, site_survey, links in self.plan_site_data():
+                for link in links:
+                    semaphore = semaphores.setdefault(urlparse(link).netloc, BoundedSemaphore(per_host))
+                    pending.append((link, site_survey, filepath, executor.submit(self.fetch_rows, link, semaphore)))
+
+                    # chunks are written in submission order, so every file stays in time order
+                    while len(pending) > 2 * workers:
+                        self.write_chunk(*pending.popleft())
+
+            while pending:
+                self.write_chunk(*pending.popleft())
+
+    def plan_site_data(self):
         # sort the keys for easier testing
         for site_code in sorted(self.site_intervals):
             intervals = self.site_intervals[site_code]
@@ -184,12 +222,24 @@ class SurveyScraper(ERDDAPScraper):
 
                 self.start = place
 
-                for link in links:
-                    try:
-                        self.ppull_data(link, site_survey, filepath)
+                yield filepath, site_survey, links
 
-                    except:
-                        continue
+    def fetch_rows(self, link, semaphore):
+        with semaphore:
+            try:
+                return list(self.open_link(link))
+
+            except Exception as e:
+                print('Could not read link:\n{}'.format(link))
+                print(e)
+                return []
+
+    def write_chunk(self, link, workbook, filepath, future):
+        try:
+            self.spull_data(link, workbook, filepath, future.result())
+
+        except Exception as e:
+            print(e)
 
     def pull_data(self, link, workbook, filepath):
         self.driver.get(link)
@@ -243,6 +293,65 @@ class SurveyScraper(ERDDAPScraper):
 
         return html
 
+    def open_link(self, link, tries=3):
+        rows = None
+
+        while rows == None and tries > 0:
+            try:
+                rows = self.stream_rows(link)
+                # the request is only made once the first row is asked for
+                first = next(rows)
+
+            except StopIteration:
+                return iter(())
+
+            except:
+                rows = None
+                print('Could not open link:\n{}'.format(link))
+                print('Number of remaining tries before moving on: {}'.format(tries))
+
+            tries -= 1
+
+        if rows == None:
+            print('Moving on.')
+            return iter(())
+
+        return chain([first], rows)
+
+    def spull_data(self, link, workbook, filepath, rows=None):
+        sheet = workbook.worksheets[0]
+        curr_row = sheet.max_row
+
+        if sheet.cell(row=curr_row, column=1).value != None:
+            curr_row += 1
+
+        # rows already downloaded by a worker, otherwise streamed from the link
+        if rows == None:
+            rows = self.open_link(link)
+
+        self.write_rows(sheet, curr_row, rows)
+
+        print('Saving progress...')
+        workbook.save(filepath)
+
+    def write_rows(self, sheet, curr_row, rows):
+        last_date = sheet.cell(row=max(1,curr_row-1), column=1).value
+
+        for row in rows:
+            # consecutive chunks share their boundary date
+            if row[0] == last_date:
+                continue
+
+            for i, val in enumerate(row):
+                # missing values are kept as the text the table used to show
+                sheet.cell(row=curr_row, column=i+1).value = 'NaN' if val != val else val
+
+            last_date = row[0]
+            curr_row += 1
+            print(' '.join([ str(val) for val in row ]))
+
+        return curr_row
+
     def ppull_data(self, link, workbook, filepath):
         sheet = workbook.worksheets[0]
         curr_row = sheet.max_row
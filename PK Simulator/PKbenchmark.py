@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+''' Seeded benchmarks of the PK simulator hot loops, reported as JSON
+
+    python PKbenchmark.py --output bench.json
+'''
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+import matplotlib
+matplotlib.use('Agg')
+
+import numpy as np
+
+from PKcontinuous import ErrorTypes, NoiseStream, Patient, PKSimulator, Prior, Therapy, infusion_integral
+from PKdifferentiable import DrugSimulator
+
+# parameters shared by every benchmark, taken from the __main__ blocks
+K_INT = 0.01
+K_SLOPE = 0.003125
+CL_CR = 50
+V_SLOPE = 0.2806
+BW = 70
+
+def timed(fn, repeat):
+    ''' Best wall time in seconds of repeat calls to fn '''
+
+    best = float('inf')
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+def grid(size):
+    ''' Evenly spaced Kslopes and Vslopes for a size x size prior '''
+
+    return np.linspace(0.001, 0.006, size), np.linspace(0.2, 0.36, size)
+
+def make_simulator(duration, grid_size=1, seed=0):
+    patient = Patient(K_SLOPE, K_INT, CL_CR, V_SLOPE, BW)
+    errors = ErrorTypes(0.1, 0, 0.1, 0.1)
+    measurement_times = [ t for start in range(0, duration, 72) for t in (start + 1, start + 11) ]
+    therapy = Therapy(duration, 12, 1, measurement_times, 7, 1.5)
+
+    return PKSimulator(patient, Prior(*grid(grid_size), patient), errors, therapy, seed=seed, closed_form=True)
+
+def bench_simulate(durations, step_sizes, repeat, seed):
+    results = []
+
+    for duration in durations:
+        for step_size in step_sizes:
+            simulator = make_simulator(duration, seed=seed)
+            seconds = timed(lambda: simulator.simulate(step_size, duration, 200, precision=2, reset=True), repeat)
+            steps = int(np.ceil(duration / step_size))
+
+            results.append({'benchmark': 'PKSimulator.simulate',
+                            'params': {'duration': duration, 'step_size': step_size},
+                            'metric': 'steps_per_second', 'value': steps / seconds})
+
+        simulator = make_simulator(duration, seed=seed)
+        seconds = timed(lambda: simulator.simulate_events(duration, 200, reset=True), repeat)
+
+        results.append({'benchmark': 'PKSimulator.simulate_events',
+                        'params': {'duration': duration},
+                        'metric': 'runs_per_second', 'value': 1 / seconds})
+
+    return results
+
+def bench_cohort(cohort_sizes, duration, repeat, seed):
+    results = []
+    simulator = make_simulator(duration, seed=seed)
+
+    for size in cohort_sizes:
+        rng = np.random.default_rng(seed)
+        k_el = K_INT + rng.normal(K_SLOPE, 0.001, size) * CL_CR
+        v_d = rng.normal(V_SLOPE, 0.05, size) * BW
+        seeds = rng.integers(0, 2**32 - 1, size)
+
+        seconds = timed(lambda: simulator.simulate_cohort(0.1, duration, 200, k_el, v_d, seeds), repeat)
+
+        results.append({'benchmark': 'PKSimulator.simulate_cohort',
+                        'params': {'duration': duration, 'cohort_size': size},
+                        'metric': 'patient_steps_per_second', 'value': size * duration / 0.1 / seconds})
+
+    return results
+
+def bench_kalman_filter(grid_sizes, repeat, seed):
+    results = []
+    patient = Patient(K_SLOPE, K_INT, CL_CR, V_SLOPE, BW)
+    dose_fn = lambda a, b, patient: infusion_integral(a, b, 0, 1, patient.k_el)
+
+    for size in grid_sizes:
+        prior = Prior(*grid(size), patient)
+        noise = NoiseStream(seed)
+        seconds = timed(lambda: prior.kalman_filter(0.9, 1.0, 200, dose_fn, 1.0, 9.0, noise), repeat)
+
+        results.append({'benchmark': 'Prior.kalman_filter',
+                        'params': {'grid_size': size * size},
+                        'metric': 'updates_per_second', 'value': 1 / seconds})
+
+    return results
+
+def bench_optimal_dose(grid_sizes, repeat, seed):
+    results = []
+
+    simulator = make_simulator(240, seed=seed)
+    seconds = timed(lambda: simulator.optimalDose(simulator.patient), repeat)
+
+    results.append({'benchmark': 'PKSimulator.optimalDose',
+                    'params': {},
+                    'metric': 'latency_seconds', 'value': seconds})
+
+    for size in grid_sizes:
+        simulator = make_simulator(240, size, seed)
+        seconds = timed(lambda: simulator.optimalInitialDose(closed_form=True), repeat)
+
+        results.append({'benchmark': 'PKSimulator.optimalInitialDose',
+                        'params': {'grid_size': size * size, 'closed_form': True},
+                        'metric': 'latency_seconds', 'value': seconds})
+
+    return results
+
+def bench_update_prior(grid_sizes, durations, repeat, seed):
+    results = []
+
+    for size in grid_sizes:
+        for duration in durations:
+            np.random.seed(seed)
+            k_slopes, v_slopes = grid(size)
+            simulator = DrugSimulator((7, 1.5), k_slopes, v_slopes, (K_INT, CL_CR, BW), (K_SLOPE, V_SLOPE), 12, duration, [12])
+            seconds = timed(lambda: simulator.update_prior(duration / 2), repeat)
+
+            results.append({'benchmark': 'DrugSimulator.update_prior',
+                            'params': {'grid_size': size * size, 'duration': duration},
+                            'metric': 'updates_per_second', 'value': 1 / seconds})
+
+    return results
+
+def run(quick=False, repeat=3, seed=0):
+    ''' Runs every benchmark and returns the report as a dictionary '''
+
+    durations = [240] if quick else [240, 1500]
+    step_sizes = [0.1] if quick else [0.1, 0.05]
+    grid_sizes = [3, 9] if quick else [3, 9, 30, 100]
+    cohort_sizes = [10, 100] if quick else [10, 100, 1000, 5000]
+
+    results = []
+    results += bench_simulate(durations, step_sizes, repeat, seed)
+    results += bench_cohort(cohort_sizes, durations[0], repeat, seed)
+    results += bench_kalman_filter(grid_sizes, repeat, seed)
+    results += bench_optimal_dose(grid_sizes, repeat, seed)
+    results += bench_update_prior(grid_sizes, durations, repeat, seed)
+
+    return {
+        'metadata': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'platform': platform.platform(),
+            'seed': seed,
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the PK simulators.')
+    parser.add_argument('--output', help='file to write the JSON report to, stdout by default')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per case, the best is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--quick', action='store_true', help='run a reduced sweep')
+    args = parser.parse_args()
+
+    report = run(args.quick, args.repeat, args.seed)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
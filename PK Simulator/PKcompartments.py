@@ -0,0 +1,218 @@
+import numpy as np
+
+from collections import OrderedDict
+from scipy.linalg import expm
+from PKcontinuous import NoiseStream, Patient, infusion_integral
+
+class CompartmentModel:
+    ''' Class designed to describe a linear model with a central compartment and peripheral ones '''
+
+    def __init__(self, k12=(), k21=(), maxsize=1024):
+        ''' Creates CompartmentModel object
+
+            k12: Transfer rate from the central compartment to each peripheral compartment as a list of numeric values
+            k21: Transfer rate from each peripheral compartment back to the central one as a list of numeric values
+            maxsize: Maximum number of cached transitions as an integer
+
+            Elimination and dosing act on the central compartment, whose elimination constant
+            and volume of distribution come from the patient, so Prior grids carry over unchanged.
+        '''
+
+        if len(k12) != len(k21):
+            raise ValueError('k12 and k21 need one rate per peripheral compartment')
+
+        self.k12 = np.asarray(k12, dtype=float)
+        self.k21 = np.asarray(k21, dtype=float)
+
+        self.maxsize = maxsize
+        self.transitions = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def compartments(self):
+        return 1 + len(self.k12)
+
+    def rate_matrix(self, k_el):
+        ''' Rate matrices of the amounts in each compartment as an (n_patients, c, c) array '''
+
+        k_el = np.atleast_1d(np.asarray(k_el, dtype=float))
+        c = self.compartments
+
+        A = np.zeros((len(k_el), c, c))
+        A[:, 0, 0] = -(k_el + self.k12.sum())
+        A[:, 0, 1:] = self.k21
+        A[:, 1:, 0] = self.k12
+        A[:, np.arange(1, c), np.arange(1, c)] = -self.k21
+
+        return A
+
+    def transition(self, k_el, dt):
+        ''' Matrix exponential and unit infusion input over a step of length dt
+
+            Both come from the exponential of the rate matrix augmented with the input column,
+            and are cached per (k_el, dt) so repeated steps cost a matrix-vector product.
+
+            Returns: 2-tuple where
+                     the first element is the (n_patients, c, c) array of transition matrices
+                     the second element is the (n_patients, c) array of unit infusion inputs
+        '''
+
+        k_el = np.atleast_1d(np.asarray(k_el, dtype=float))
+        key = (k_el.tobytes(), round(float(dt), 12))
+
+        if key in self.transitions:
+            self.hits += 1
+            self.transitions.move_to_end(key)
+            return self.transitions[key]
+
+        self.misses += 1
+        c = self.compartments
+
+        augmented = np.zeros((len(k_el), c + 1, c + 1))
+        augmented[:, :c, :c] = self.rate_matrix(k_el)
+        augmented[:, 0, c] = 1
+
+        exponential = expm(augmented * dt)
+        value = (exponential[:, :c, :c], exponential[:, :c, c])
+
+        self.transitions[key] = value
+
+        if len(self.transitions) > self.maxsize:
+            self.transitions.popitem(last=False)
+
+        return value
+
+class CompartmentSimulator:
+    ''' Class for conducting multi-compartment pharmacokinetic simulations '''
+
+    def __init__(self, model, patient, priors, errors, therapy, seed=None, block_size=4096):
+        ''' Creates CompartmentSimulator object
+
+            model: CompartmentModel shared by every patient
+            patient: Patient whose k_el and v_d belong to the central compartment
+            priors: Prior or ParticlePosterior updated with each measurement
+            errors: ErrorTypes of the simulation
+            therapy: Therapy giving the dosing schedule, measurement times and goals
+            seed: Seed of the simulator's noise stream
+            block_size: Number of normal draws generated at once by the noise stream
+        '''
+
+        self.model = model
+        self.patient = patient
+        self.priors = priors
+        self.errors = errors
+        self.therapy = therapy
+        self.noise = NoiseStream(seed, block_size)
+
+        self.measurements = []
+
+    def steps(self, step_size, stop_time, precision=1):
+        ''' Sorted step ends on a fixed grid, split at every dose boundary and measurement '''
+
+        grid = np.round(step_size * np.arange(1, int(np.ceil(stop_time / step_size)) + 1), precision)
+        events = self.therapy.events(0, stop_time)
+
+        times = np.unique(np.concatenate((grid[grid <= stop_time], events, [stop_time])))
+
+        return times[times > 0]
+
+    def simulate(self, step_size, stop_time, dose, patients=None, precision=1):
+        ''' Simulates one patient or a batch of patients
+
+            step_size: Length in hours of each step as a numeric value
+            stop_time: Time in hours at which the simulation stops as a numeric value
+            dose: Dose given at each dosage interval as a numeric value or one per patient
+            patients: Patient or PatientBatch to simulate, defaults to the simulator's patient
+            precision: Number of digits the fixed grid is rounded to
+
+            Steps are split at dose boundaries so each one is either fully inside or fully
+            outside an infusion. Dosage errors are drawn once per dosage interval. Measurements
+            update the prior only when a single patient is simulated.
+
+            Returns: 3-tuple where
+                     the first element is the array of time steps
+                     the second element is the (n_patients, n_steps, c) array of amounts
+                     the third element is the (n_patients, n_steps) array of central concentrations
+        '''
+
+        if patients == None:
+            patients = self.patient
+
+        single = isinstance(patients, Patient)
+        k_el = np.atleast_1d(np.asarray(patients.k_el, dtype=float)).ravel()
+        v_d = np.atleast_1d(np.asarray(patients.v_d, dtype=float)).ravel()
+        doses = np.broadcast_to(np.asarray(dose, dtype=float), k_el.shape)
+
+        period = self.therapy.dosage_period
+        length = self.therapy.dosage_length
+
+        times = np.concatenate(([0], self.steps(step_size, stop_time, precision)))
+        amounts = np.zeros((len(k_el), len(times), self.model.compartments))
+        dosage_errors = {}
+
+        for idx in range(1, len(times)):
+            a = times[idx - 1]
+            b = times[idx]
+
+            interval = int(a // period)
+            tk = interval * period
+            infusing = a < tk + length
+
+            if interval not in dosage_errors:
+                dosage_errors[interval] = self.errors.dosage * self.noise.standard_normal(len(k_el))
+
+            transition, infusion = self.model.transition(k_el, b - a)
+            amounts[:, idx] = np.einsum('nij,nj->ni', transition, amounts[:, idx - 1])
+
+            if infusing:
+                gain = (doses * (1 + dosage_errors[interval]))[:, np.newaxis] * infusion
+                amounts[:, idx] += gain
+
+            if single and self.therapy.is_measurement(b):
+                concentration = amounts[0, idx, 0] / v_d[0]
+                measurement_error = self.noise.normal(0, self.errors.measurement)
+                self.measurements.append(concentration + measurement_error)
+
+                # the prior tracks the central compartment as a one-compartment model
+                dose_fn = lambda a, b, patient: infusion_integral(a, b, tk, tk + length, patient.k_el)
+                M_error = np.sqrt((1-np.exp(-2*k_el[0]*(b-a)))/(2*k_el[0]))
+                D_error = doses[0] * infusion[0, 0] * dosage_errors[interval][0] if infusing else 0
+                T_error = 1
+
+                self.priors.kalman_filter(a, b, doses[0], dose_fn, M_error+D_error+T_error, self.measurements[-1], self.noise)
+
+        return times, amounts, amounts[:, :, 0] / v_d[:, np.newaxis]
+
+    def optimal_doses(self, k_el, v_d):
+        ''' Solves for the least-squares peak/trough dose of each patient in closed form
+
+            The peak is taken at the end of the first infusion and the trough an hour before
+            the next dose, as in PKSimulator.optimalDose.
+
+            Returns: Optimal dose for every pair of parameters as an array
+        '''
+
+        shape = np.shape(k_el)
+        k_el = np.ravel(k_el)
+        v_d = np.ravel(v_d)
+
+        length = self.therapy.dosage_length
+        trough_time = self.therapy.dosage_period - 1
+
+        _, infusion = self.model.transition(k_el, length)
+        decay, _ = self.model.transition(k_el, trough_time - length)
+
+        # central concentration per unit dose at the peak and at the trough
+        beta_peak = infusion[:, 0] / v_d
+        beta_trough = np.einsum('nj,nj->n', decay[:, 0, :], infusion) / v_d
+
+        numer = beta_peak*self.therapy.peak + beta_trough*self.therapy.trough
+        denom = beta_peak**2 + beta_trough**2
+
+        return (numer / denom).reshape(shape)
+
+    def optimalInitialDose(self):
+        ''' Weighted optimal dose over the whole prior '''
+
+        return np.sum(self.priors.weights * self.optimal_doses(self.priors.k_el, self.priors.v_d))
@@ -1,11 +1,15 @@
 import matplotlib.pyplot as plt
 import numpy as np
 
+from collections import OrderedDict
 from pprint import pprint
+from PKplotting import draw_trajectory, new_axes
 
 class Patient:
     ''' Class designed to hold all relevent patient parameters '''
     
+    __slots__ = ('k_slope', 'k_int', 'cl_cr', 'v_slope', 'bw', 'k_el', 'v_d')
+    
     def __init__(self, k_slope, k_int, cl_cr, v_slope, bw):
         ''' Creates Patient object
         
@@ -26,6 +30,54 @@ class Patient:
         self.k_el = k_int + k_slope * cl_cr
         self.v_d = v_slope * bw
         
+class PatientBatch:
+    ''' Class designed to hold the parameters of many patients as contiguous arrays '''
+    
+    __slots__ = ('k_slope', 'k_int', 'cl_cr', 'v_slope', 'bw', 'k_el', 'v_d')
+    
+    def __init__(self, k_slope, k_int, cl_cr, v_slope, bw):
+        ''' Creates PatientBatch object
+        
+            Takes the same parameters as Patient, each as a numeric value or an array;
+            arrays are broadcast against each other to give the shape of the batch.
+        '''
+        
+        self.k_slope = np.asarray(k_slope, dtype=float)
+        self.k_int = k_int
+        self.cl_cr = cl_cr
+        
+        self.v_slope = np.asarray(v_slope, dtype=float)
+        self.bw = bw
+        
+        k_el, v_d = np.broadcast_arrays(k_int + self.k_slope * cl_cr, self.v_slope * bw)
+        self.k_el = np.ascontiguousarray(k_el)
+        self.v_d = np.ascontiguousarray(v_d)
+        
+    @classmethod
+    def from_grid(cls, k_slopes, v_slopes, patient):
+        ''' Creates the (len(k_slopes), len(v_slopes)) batch sharing patient's known parameters '''
+        
+        k_slopes = np.asarray(k_slopes, dtype=float)[:, np.newaxis]
+        v_slopes = np.asarray(v_slopes, dtype=float)[np.newaxis, :]
+        
+        return cls(k_slopes, patient.k_int, patient.cl_cr, v_slopes, patient.bw)
+    
+    def __len__(self):
+        return self.k_el.size
+    
+    @property
+    def shape(self):
+        return self.k_el.shape
+    
+    def patient(self, *index):
+        ''' Builds the Patient at index '''
+        
+        k_slope = np.broadcast_to(self.k_slope, self.shape)[index]
+        v_slope = np.broadcast_to(self.v_slope, self.shape)[index]
+        k_int, cl_cr, bw = ( np.broadcast_to(value, self.shape)[index] for value in (self.k_int, self.cl_cr, self.bw) )
+        
+        return Patient(k_slope, k_int, cl_cr, v_slope, bw)
+        
 class Prior:
     ''' Class designed to hold weights for discrete prior '''
     
@@ -34,87 +86,228 @@ class Prior:
         
             k_slopes: Each Kslope to be used in discrete prior as a list of numeric values
             v_slopes: Each Vslope to be used in discrete prior as a list of numeric values
-            patient: 
+            patient: Patient whose known parameters are shared by every grid point
         '''
         
-        self.k_slopes = k_slopes
-        self.v_slopes = v_slopes
+        self.k_slopes = np.asarray(k_slopes, dtype=float)
+        self.v_slopes = np.asarray(v_slopes, dtype=float)
         self.patient = patient
+        self.patients = PatientBatch.from_grid(self.k_slopes, self.v_slopes, patient)
         self.weights = self.initialize_weights()
-        self.state = self.initialize_state()
+        self.x_hat, self.P = self.initialize_state()
+        
+    @property
+    def k_el(self):
+        return self.patients.k_el
+    
+    @property
+    def v_d(self):
+        return self.patients.v_d
+    
+    @property
+    def update_draws(self):
+        # kalman_filter draws one normal per grid point
+        return self.weights.size
         
     def initialize_weights(self):
         ''' Initializes the discrete prior used in the simulation
         
-            Returns: 2-dimensional list of 3-tuples where
-                     the first element of the tuple is the weight
-                     the second element of the tuple is the patient with distinct parameters
+            Returns: (len(k_slopes), len(v_slopes)) array of uniform weights
         '''
         
-        weights = [[]]
-        weight = (len(self.k_slopes) * len(self.v_slopes))**(-1)
+        shape = (len(self.k_slopes), len(self.v_slopes))
         
-        for k_slope in self.k_slopes:
-            for v_slope in self.v_slopes:
-                k_int = self.patient.k_int
-                cl_cr = self.patient.cl_cr
-                bw = self.patient.bw
-                
-                patient = Patient(k_slope, k_int, cl_cr, v_slope, bw)
-                
-                weights[-1].append((weight, patient))
-                
-            weights.append([])
-            
-        return weights
+        return np.full(shape, 1 / (shape[0] * shape[1]))
     
     def initialize_state(self):
+        ''' Initializes the Kalman filter state of every grid point
         
-        state = [[]]
-        for i in range(len(self.k_slopes)):
-            for j in range(len(self.v_slopes)):
-                x_hat = 0
-                P = 1
-                
-                state[-1].append((x_hat, P))
-                
-            state.append([])
-                
-        return state
+            Returns: 2-tuple of (len(k_slopes), len(v_slopes)) arrays where
+                     the first element holds the state means
+                     the second element holds the state variances
+        '''
+        
+        shape = (len(self.k_slopes), len(self.v_slopes))
+        
+        return np.zeros(shape), np.ones(shape)
     
-    def kalman_filter(self, a, b, dose, dose_fn, error, y):
-        total = 0
+    def patient_at(self, i, j):
+        ''' Builds the Patient at grid point (i, j) '''
         
-        for i in range(len(self.k_slopes)):
-            for j in range(len(self.v_slopes)):
-                weight, patient = self.weights[i][j]
-                
-                x_next, P = self.state[i][j]
-                
-                x_prev = np.exp(-patient.k_el*(b-a))*x_next + dose*dose_fn(a, b, patient)
-                M_next = np.exp(-2*patient.k_el*(b-a))*P + error
-                #print(M_next)
-                
-                omega_next = M_next + 1
-                
-                P_next = M_next - M_next**2/omega_next
-                x_next = x_prev + P_next*(y - x_prev)
-                
-                self.state[i][j] = (x_next, P_next)
-                update = np.random.normal(y - x_prev, 1)#omega_next)
-                total += update*weight # duh
-                
-                self.weights[i][j] = (update*weight, patient)
-                
-        for i in range(len(self.k_slopes)):
-            for j in range(len(self.v_slopes)):
-                weight, patient = self.weights[i][j]
+        return self.patients.patient(i, j)
+    
+    def kalman_filter(self, a, b, dose, dose_fn, error, y, noise=None):
+        # every grid point is updated at once, dose_fn only needs k_el
+        # noise is the caller's NoiseStream, the global generator if None
+        if noise == None:
+            noise = np.random
+            
+        x_prev = np.exp(-self.k_el*(b-a))*self.x_hat + dose*dose_fn(a, b, self)
+        M_next = np.exp(-2*self.k_el*(b-a))*self.P + error
+        
+        omega_next = M_next + 1
+        
+        P_next = M_next - M_next**2/omega_next
+        x_next = x_prev + P_next*(y - x_prev)
+        
+        self.x_hat = x_next
+        self.P = P_next
+        update = noise.normal(y - x_prev, 1)#omega_next)
+        
+        self.weights = update*self.weights
+        self.weights /= self.weights.sum()
                 
-                self.weights[i][j] = (weight/total, patient)
+class ParticlePosterior:
+    ''' Class designed to hold a sequential importance resampling posterior '''
+    
+    def __init__(self, k_slopes, v_slopes, patient, therapy, threshold=0.5, jitter=0.1, measurement_variance=1, seed=None):
+        ''' Creates ParticlePosterior object
+        
+            k_slopes: Kslope of each particle as a list of numeric values
+            v_slopes: Vslope of each particle as a list of numeric values of the same length
+            patient: Patient whose known parameters are shared by every particle
+            therapy: Therapy whose dosing schedule the particles are propagated through
+            threshold: Fraction of the particle count the effective sample size may drop to before resampling
+            jitter: Bandwidth of the shrinkage kernel applied to resampled particles as a numeric value in [0, 1)
+            measurement_variance: Variance of the measurement noise as a numeric value
+            seed: Seed of the resampling stream
+        '''
+        
+        self.k_slopes = np.array(k_slopes, dtype=float)
+        self.v_slopes = np.array(v_slopes, dtype=float)
+        self.patient = patient
+        self.therapy = therapy
+        
+        self.threshold = threshold
+        self.jitter = jitter
+        self.measurement_variance = measurement_variance
+        self.rng = np.random.default_rng(seed)
+        
+        self.initialize_parameters()
+        self.log_weights = np.full(len(self.k_slopes), -np.log(len(self.k_slopes)))
+        self.x_hat = np.zeros(len(self.k_slopes))
+        self.P = np.ones(len(self.k_slopes))
+        
+        # time the particle states were last propagated to
+        self.time = 0
+        
+    @classmethod
+    def from_population(cls, num, patient, therapy, k_slope_params, v_slope_params, **kwargs):
+        ''' Draws num particles from the population distributions
+        
+            k_slope_params: Kslope mixture as (p, mean1, stdev1, mean2, stdev2), as consumed by sample_k_slopes
+            v_slope_params: Vslope distribution as (mean, stdev), as consumed by sample_v_slopes
+            
+            The particles come from the seed keyword argument, whose stream then goes on to drive resampling.
+        '''
+        
+        rng = np.random.default_rng(kwargs.get('seed'))
+        k_slopes, v_slopes = sample_population(rng, num, k_slope_params, v_slope_params)
+        
+        posterior = cls(k_slopes, v_slopes, patient, therapy, **kwargs)
+        posterior.rng = rng
+        
+        return posterior
+        
+    @property
+    def weights(self):
+        return np.exp(self.log_weights)
+    
+    @property
+    def k_el(self):
+        return self.patients.k_el
+    
+    @property
+    def v_d(self):
+        return self.patients.v_d
+    
+    @property
+    def update_draws(self):
+        # kalman_filter draws nothing from the noise stream
+        return 0
+        
+    def initialize_parameters(self):
+        ''' Derives the elimination constant and volume of distribution of every particle '''
+        
+        self.patients = PatientBatch(self.k_slopes, self.patient.k_int, self.patient.cl_cr, self.v_slopes, self.patient.bw)
+        
+    def patient_at(self, i):
+        ''' Builds the Patient of particle i '''
+        
+        return self.patients.patient(i)
+    
+    def effective_sample_size(self):
+        return 1 / np.sum(self.weights**2)
+    
+    def kalman_filter(self, a, b, dose, dose_fn, error, y, noise=None):
+        ''' Propagates every particle to time b and weighs it by the measured concentration y
+        
+            Particles are propagated from the time of the previous update through every
+            dose of the therapy given since, assuming dose was given at each of them, so
+            a and dose_fn, which only cover the last step, are not needed.
+            
+            Unlike Prior, the measurement is compared with the predicted concentration
+            rather than the amount, and weights follow the Gaussian predictive likelihood.
+            The update draws no noise, so noise is accepted only to match Prior.
+        '''
+        
+        if b < self.time:
+            raise ValueError('Measurements must arrive in time order, got {} after {}'.format(b, self.time))
+            
+        # input over [time, b] is the unit-dose amount at b less what was already there at time
+        decay = np.exp(-self.k_el*(b-self.time))
+        before, _ = superposition(self.time, self.k_el, self.therapy.dosage_period, self.therapy.dosage_length)
+        after, _ = superposition(b, self.k_el, self.therapy.dosage_period, self.therapy.dosage_length)
+        
+        x_prev = decay*self.x_hat + dose*(after - decay*before)
+        M_next = decay**2*self.P + error
+        self.time = b
+        
+        # measurement of the concentration x/v_d
+        H = 1 / self.v_d
+        omega_next = H**2*M_next + self.measurement_variance
+        gain = M_next*H/omega_next
+        residual = y - H*x_prev
+        
+        self.x_hat = x_prev + gain*residual
+        self.P = M_next*(1 - gain*H)
+        
+        self.log_weights -= 0.5*(np.log(2*np.pi*omega_next) + residual**2/omega_next)
+        self.log_weights -= np.logaddexp.reduce(self.log_weights)
+        
+        if self.effective_sample_size() < self.threshold * len(self.log_weights):
+            self.resample()
+            
+    def resample(self):
+        ''' Systematically resamples the particles and jitters them with a shrinkage kernel '''
+        
+        num = len(self.log_weights)
+        weights = self.weights
+        
+        positions = (self.rng.uniform() + np.arange(num)) / num
+        parents = np.minimum(np.searchsorted(np.cumsum(weights), positions), num - 1)
+        
+        # kernel shrunk towards the weighted mean so the spread is preserved
+        shrink = np.sqrt(1 - self.jitter**2)
+        
+        for name in ('k_slopes', 'v_slopes'):
+            values = getattr(self, name)
+            mean = np.sum(weights * values)
+            stdev = np.sqrt(np.sum(weights * (values - mean)**2))
+            
+            jittered = shrink*values[parents] + (1 - shrink)*mean + self.jitter*stdev*self.rng.standard_normal(num)
+            setattr(self, name, jittered)
+            
+        self.x_hat = self.x_hat[parents]
+        self.P = self.P[parents]
+        self.log_weights = np.full(num, -np.log(num))
+        self.initialize_parameters()
                 
 class ErrorTypes:
     ''' Class designed to hold all errors relevent to the simulation '''
     
+    __slots__ = ('measurement', 'measurement_timing', 'dosage', 'dosage_timing')
+    
     def __init__(self, measurement, measurement_timing, dosage, dosage_timing):
         ''' Creates ErrorTypes object
         
@@ -132,6 +325,8 @@ class ErrorTypes:
 class Therapy:
     ''' Class designed to hold details about therapeutic session '''
     
+    __slots__ = ('duration', '_dosage_period', '_dosage_length', '_measurement_times', 'peak', 'trough', 'measurement_index', '_events', '_horizon')
+    
     def __init__(self, duration, dosage_period, dosage_length, measurement_times, peak, trough):
         ''' Creates Therapy object
         
@@ -141,30 +336,237 @@ class Therapy:
             measurement_times: Times at which measurements will be taken as a list of numeric values
             peak: Peak therapeutic goal in mg/L as a numeric value
             trough: Trough therapeutic goal in mg/L as a numeric value
+            
+            The schedule is indexed once; assigning dosage_period, dosage_length or
+            measurement_times rebuilds the index, changing the list in place does not.
         '''
         
         self.duration = duration
-        self.dosage_period = dosage_period
-        self.dosage_length = dosage_length
-        self.measurement_times = measurement_times
+        self._dosage_period = dosage_period
+        self._dosage_length = dosage_length
+        self._measurement_times = measurement_times
         self.peak = peak
         self.trough = trough
         
+        self.index_events()
+        
+    @property
+    def dosage_period(self):
+        return self._dosage_period
+    
+    @dosage_period.setter
+    def dosage_period(self, value):
+        self._dosage_period = value
+        self.index_events()
+        
+    @property
+    def dosage_length(self):
+        return self._dosage_length
+    
+    @dosage_length.setter
+    def dosage_length(self, value):
+        self._dosage_length = value
+        self.index_events()
+        
+    @property
+    def measurement_times(self):
+        return self._measurement_times
+    
+    @measurement_times.setter
+    def measurement_times(self, value):
+        self._measurement_times = value
+        self.index_events()
+        
+    def index_events(self, horizon=None):
+        ''' Builds the measurement set and the sorted events up to horizon, the duration by default '''
+        
+        # constant time lookups while stepping
+        self.measurement_index = frozenset(self._measurement_times)
+        
+        measurement_times = np.asarray(self._measurement_times, dtype=float)
+        self._horizon = max(self.duration if horizon == None else horizon, np.max(measurement_times, initial=0))
+        
+        starts = self._dosage_period * np.arange(int(np.ceil(self._horizon / self._dosage_period)) + 1)
+        
+        self._events = np.unique(np.concatenate((starts, starts + self._dosage_length, measurement_times)))
+        
+    def is_measurement(self, t):
+        ''' Whether a measurement is taken at time t '''
+        
+        return t in self.measurement_index
+    
+    def events(self, start_time, stop_time):
+        ''' Sorted dose boundaries and measurement times in (start_time, stop_time] as an array '''
+        
+        # runs past the indexed horizon double it
+        if stop_time > self._horizon:
+            self.index_events(max(stop_time, 2 * self._horizon))
+            
+        lo = np.searchsorted(self._events, start_time, side='right')
+        hi = np.searchsorted(self._events, stop_time, side='right')
+        
+        return self._events[lo:hi]
+        
+class NoiseStream:
+    ''' Class designed to serve normal draws from blocks pre-drawn by a Generator '''
+    
+    def __init__(self, seed=None, block_size=4096):
+        ''' Creates NoiseStream object
+        
+            seed: Seed of the generator, anything np.random.default_rng accepts
+            block_size: Number of standard normal draws generated at once as an integer
+            
+            A Generator produces the same standard normals whether they are asked for
+            one at a time or in blocks, so the stream does not depend on block_size.
+        '''
+        
+        self.rng = np.random.default_rng(seed)
+        self.block_size = block_size
+        
+        self.block = np.empty(0)
+        self.position = 0
+        
+    def standard_normal(self, size=None):
+        ''' Next draw, or the next size draws as an array '''
+        
+        if size == None:
+            if self.position == len(self.block):
+                self.refill()
+                
+            value = self.block[self.position]
+            self.position += 1
+            
+            return value
+        
+        count = int(np.prod(size))
+        values = np.empty(count)
+        filled = 0
+        
+        while filled < count:
+            if self.position == len(self.block):
+                self.refill()
+                
+            take = min(count - filled, len(self.block) - self.position)
+            values[filled:filled + take] = self.block[self.position:self.position + take]
+            
+            filled += take
+            self.position += take
+            
+        return values.reshape(size)
+    
+    def normal(self, loc=0, scale=1):
+        ''' Normal draws shaped like loc and scale broadcast together '''
+        
+        # broadcasting costs more than the draw itself for scalars
+        if isinstance(loc, (int, float)) and isinstance(scale, (int, float)):
+            return loc + scale * self.standard_normal()
+        
+        shape = np.broadcast(loc, scale).shape
+        
+        return loc + scale * self.standard_normal(shape if shape else None)
+    
+    def spawn_seeds(self, num):
+        ''' Seeds of num independent streams, handed out without advancing this one
+        
+            Drawing them from the generator would shift the blocks still to come,
+            making the stream depend on block_size.
+        '''
+        
+        children = self.rng.bit_generator.seed_seq.spawn(num)
+        
+        return np.array([ child.generate_state(1)[0] for child in children ])
+    
+    def refill(self):
+        self.block = self.rng.standard_normal(self.block_size)
+        self.position = 0
+        
+class DoseCache:
+    ''' Class designed to memoize optimal doses with least recently used eviction '''
+    
+    def __init__(self, maxsize=4096):
+        ''' Creates DoseCache object
+        
+            maxsize: Maximum number of doses kept as an integer
+        '''
+        
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        
+        self.hits = 0
+        self.misses = 0
+        
+    def therapy_key(self, therapy):
+        ''' Fields of the therapy that determine the optimal dose '''
+        
+        return (therapy.dosage_period, therapy.dosage_length, therapy.peak, therapy.trough)
+        
+    def key(self, patient, therapy, *options):
+        ''' Builds the lookup key for a patient, a therapy and solver options '''
+        
+        return (float(patient.k_el), float(patient.v_d), self.therapy_key(therapy), options)
+    
+    def get(self, key):
+        ''' Returns the cached dose for key or None, counting hits and misses '''
+        
+        dose = self.entries.get(key)
+        
+        if dose == None:
+            self.misses += 1
+            
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            
+        return dose
+    
+    def put(self, key, dose):
+        ''' Stores a dose, evicting the least recently used one when full '''
+        
+        self.entries[key] = dose
+        self.entries.move_to_end(key)
+        
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            
+    def invalidate(self, therapy=None):
+        ''' Drops every dose cached for therapy, or all doses if therapy is None '''
+        
+        if therapy == None:
+            self.entries.clear()
+            return
+        
+        target = self.therapy_key(therapy)
+        
+        for key in [ key for key in self.entries if key[2] == target ]:
+            del self.entries[key]
+            
+    def info(self):
+        ''' Returns the hit and miss counters along with the cache size '''
+        
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'maxsize': self.maxsize}
+        
 class PKSimulator:
     ''' Class for conducting pharmacokinetic simulations '''
     
-    def __init__(self, patient, priors, errors, therapy):
+    def __init__(self, patient, priors, errors, therapy, cache=None, seed=None, block_size=4096, dose=None, closed_form=False):
         ''' Creates PKSimulator object 
+        
+            cache: DoseCache shared by optimalDose calls, no caching if None
+            seed: Seed of the simulator's noise stream
+            block_size: Number of normal draws generated at once by the noise stream
+            dose: Initial dose, found by optimalInitialDose if None
+            closed_form: Whether optimalInitialDose uses the closed form instead of bisecting every grid point
         '''
         
         self.patient = patient
         self.priors = priors
         self.errors = errors
         self.therapy = therapy
+        self.cache = cache
+        self.noise = NoiseStream(seed, block_size)
         
-        self.time_steps = [0]
-        self.amount_steps = [0]
-        self.concentration_steps = [0]
+        # trajectory buffers sized for the whole therapy at the default step
+        self.allocate(int(np.ceil(therapy.duration / 0.1)) + 1)
         
         self.measurements = []
         
@@ -173,105 +575,575 @@ class PKSimulator:
         
         self.dosage_interval = 0
         
-        self.dose = self.optimalInitialDose()
+        # the trial runs of optimalDose are not observations of the patient
+        self.updating = True
+        
+        self.dose = self.optimalInitialDose(closed_form) if dose == None else dose
+        
+    @property
+    def time_steps(self):
+        return self._time_buffer[:self.n_steps]
+    
+    @property
+    def amount_steps(self):
+        return self._amount_buffer[:self.n_steps]
+    
+    @property
+    def concentration_steps(self):
+        return self._concentration_buffer[:self.n_steps]
+        
+    def allocate(self, capacity):
+        ''' Replaces the trajectory buffers with empty ones holding only the initial state '''
+        
+        self._time_buffer = np.zeros(max(capacity, 1))
+        self._amount_buffer = np.zeros(max(capacity, 1))
+        self._concentration_buffer = np.zeros(max(capacity, 1))
+        self.n_steps = 1
+        
+    def reserve(self, steps):
+        ''' Grows the trajectory buffers so that steps more points fit '''
+        
+        capacity = len(self._time_buffer)
+        
+        if self.n_steps + steps <= capacity:
+            return
+        
+        capacity = max(self.n_steps + steps, 2 * capacity)
+        
+        for name in ('_time_buffer', '_amount_buffer', '_concentration_buffer'):
+            buffer = np.zeros(capacity)
+            buffer[:self.n_steps] = getattr(self, name)[:self.n_steps]
+            setattr(self, name, buffer)
+            
+    def record(self, t, amount, concentration):
+        ''' Appends a point to the trajectory '''
+        
+        if self.n_steps == len(self._time_buffer):
+            self.reserve(1)
+            
+        self._time_buffer[self.n_steps] = t
+        self._amount_buffer[self.n_steps] = amount
+        self._concentration_buffer[self.n_steps] = concentration
+        self.n_steps += 1
+        
+    def extend(self, times, amounts, v_d):
+        ''' Appends many points to the trajectory at once '''
+        
+        steps = len(times)
+        self.reserve(steps)
+        
+        start, stop = self.n_steps, self.n_steps + steps
+        self._time_buffer[start:stop] = times
+        self._amount_buffer[start:stop] = amounts
+        self._concentration_buffer[start:stop] = self._amount_buffer[start:stop] / v_d
+        self.n_steps = stop
+        
+    def reset(self):
+        ''' Clears the simulation and returns the finished trajectory '''
+        
+        info = (self.time_steps, self.amount_steps, self.concentration_steps)
+        
+        self.allocate(len(self._time_buffer))
+        
+        self.measurements = []
+    
+        self.dosage_errors = []
+        self.dosage_timing_errors = []
+    
+        self.dosage_interval = 0
+        self.doses = []
+        
+        return info
         
     def simulate(self, step_size, stop_time, dose, patient=None, precision=1, reset=False):
         
         if patient == None:
             patient = self.patient
             
-        while self.time_steps[-1] < stop_time: 
-            a = self.time_steps[-1]
-            b = a + step_size
-            b = round(b, precision)
+        # Python floats keep round() and the arithmetic below off the numpy scalar path
+        b = float(self._time_buffer[self.n_steps - 1])
+        prev = float(self._amount_buffer[self.n_steps - 1])
+        
+        # the time grid is laid out first so the noise of every step is drawn in one call
+        grid = time_grid(b, step_size, stop_time, precision)
+        
+        steps = len(grid) - 1
+        step_noise = self.noise.standard_normal((steps, 2))
+        dosage_noise = self.errors.dosage * step_noise[:, 0]
+        timing_noise = self.errors.dosage_timing * step_noise[:, 1]
+        
+        # amounts are collected locally and copied into the buffers once
+        amounts = []
+        dt = None
+            
+        for step in range(steps): 
+            a = b
+            b = float(grid[step + 1])
             #print(self.time_steps[-1], stop_time)
                        
             if a > self.therapy.dosage_period * self.dosage_interval + self.therapy.dosage_length:
                 self.dosage_interval += 1
                 
             if len(self.dosage_errors) == self.dosage_interval:
-                percent_error = np.random.normal(0, self.errors.dosage)
+                percent_error = self.noise.normal(0, self.errors.dosage)
                 self.dosage_errors.append(percent_error)
             
-            prev = self.amount_steps[-1]
-            loss = np.exp(-patient.k_el*(b-a))
+            # the decay and its noise scale only change with the step length
+            if b - a != dt:
+                dt = b - a
+                loss = np.exp(-patient.k_el*dt)
+                M_error = np.sqrt((1-np.exp(-2*patient.k_el*dt))/(2*patient.k_el))
+                
             gain = dose * self.administer(a, b, patient)
                 
-            M_error = np.sqrt((1-np.exp(-2*patient.k_el*(b-a)))/(2*patient.k_el))
             D_error = gain * self.dosage_errors[-1]
             T_error = 1
             #print(M_error, D_error, T_error)
             
             #w1 = np.random.normal(0, self.errors.)
-            w2 = np.random.normal(0, self.errors.dosage)
-            w3 = np.random.normal(0, self.errors.dosage_timing)
+            w2 = dosage_noise[step]
+            w3 = timing_noise[step]
             
             curr = prev*loss + gain + M_error + D_error*w2 + T_error*w3
             
-            self.amount_steps.append(curr)
-            self.concentration_steps.append(curr/patient.v_d)
-            self.time_steps.append(b)  
+            amounts.append(curr)
+            prev = curr
 
-            if b in self.therapy.measurement_times:
-                measurement_error = np.random.normal(0, self.errors.measurement)
-                self.measurements.append(self.concentration_steps[-1] + measurement_error)
-                self.priors.kalman_filter(a, b, dose, self.administer, M_error+D_error+T_error, self.measurements[-1])
+            if self.therapy.is_measurement(b):
+                measurement_error = self.noise.normal(0, self.errors.measurement)
+                self.measurements.append(curr/patient.v_d + measurement_error)
                 
-        if reset:
-            info = (self.time_steps, self.amount_steps, self.concentration_steps)
+                if self.updating:
+                    self.priors.kalman_filter(a, b, dose, self.administer, M_error+D_error+T_error, self.measurements[-1], self.noise)
+                
+        self.extend(grid[1:], amounts, patient.v_d)
                 
-            self.time_steps = [0]
-            self.amount_steps = [0]
-            self.concentration_steps = [0]
+        if reset:
+            return self.reset()
+    
+    def simulate_events(self, stop_time, dose, patient=None, dense_times=None, reset=False):
+        ''' Simulates by jumping between dose and measurement events using the exact solution
+        
+            stop_time: Time in hours at which the simulation stops as a numeric value
+            dose: Dose given at each dosage interval as a numeric value
+            patient: Patient to simulate, defaults to the simulator's patient
+            dense_times: Additional times at which to record the solution as a list of numeric values
+            reset: Whether to return the trajectory and reset the simulator
+            
+            Between events the amount follows the closed form of the one-compartment
+            infusion model, so only dosage errors (one per dosage interval) perturb
+            the trajectory; the per-step noise terms of simulate depend on the step
+            size and have no counterpart here.
+        '''
+        
+        if patient == None:
+            patient = self.patient
+            
+        b = self._time_buffer[self.n_steps - 1]
+        prev = self._amount_buffer[self.n_steps - 1]
+        
+        # infusion boundaries, measurements, requested output and the stop time, all after b
+        events = [self.therapy.events(b, stop_time), [stop_time] if stop_time > b else []]
+
+        if dense_times is not None:
+            dense_times = np.asarray(dense_times, dtype=float)
+            events.append(dense_times[(dense_times > b) & (dense_times <= stop_time)])
+            
+        events = np.unique(np.concatenate(events)).tolist()
+        self.reserve(len(events))
+        
+        for b in events:
+            a = self._time_buffer[self.n_steps - 1]
+            curr, D_error = self.exact_step(a, b, prev, dose, patient)
+            
+            self.record(b, curr, curr/patient.v_d)
+            prev = curr
+            
+            if self.therapy.is_measurement(b):
+                self.measure(a, b, curr, dose, patient, D_error)
                 
-            self.measurements = []
+        if reset:
+            return self.reset()
+        
+    def simulate_adaptive(self, stop_time, dose, patient=None, rtol=1e-3, atol=1e-3, max_step=None, min_step=1e-4, reset=False):
+        ''' Simulates with step sizes chosen from a local error estimate, landing exactly on events
+        
+            stop_time: Time in hours at which the simulation stops as a numeric value
+            dose: Dose given at each dosage interval as a numeric value
+            patient: Patient to simulate, defaults to the simulator's patient
+            rtol: Relative tolerance on the amount as a numeric value
+            atol: Absolute tolerance on the amount as a numeric value
+            max_step: Longest step in hours, defaults to the dosage period
+            min_step: Shortest step in hours, accepted whatever its error
+            reset: Whether to return the trajectory and reset the simulator
+            
+            Each step uses the exact solution, so the error estimate is how far the exact
+            midpoint lies from the straight line between the ends of the step; the recorded
+            trajectory can then be interpolated linearly within tolerance. Steps are cut short
+            to land on dose boundaries and measurement times.
+            
+            The process noise of a step of length h has variance
+            dosage_timing * (1 - exp(-2*k_el*h)) / (2*k_el), the exact increment of the
+            Ornstein-Uhlenbeck process, so one long step has the same distribution as many
+            short ones. Dosage errors are drawn once per dosage interval.
+        '''
         
-            self.dosage_errors = []
-            self.dosage_timing_errors = []
+        if patient == None:
+            patient = self.patient
+            
+        if max_step == None:
+            max_step = self.therapy.dosage_period
+            
+        b = self._time_buffer[self.n_steps - 1]
+        prev = self._amount_buffer[self.n_steps - 1]
+        
+        events = np.unique(np.concatenate((self.therapy.events(b, stop_time), [stop_time]))).tolist()
+        h = max_step
         
-            self.dosage_interval = 0
-            self.doses = []
+        for event in events:
+            while b < event:
+                a = b
+                h = min(h, max_step)
+                
+                while True:
+                    # land exactly on the event rather than next to it
+                    b = event if a + h >= event else a + h
+                    
+                    curr, D_error = self.exact_step(a, b, prev, dose, patient)
+                    mid, _ = self.exact_step(a, (a + b) / 2, prev, dose, patient)
+                    
+                    error = abs(mid - (prev + curr) / 2)
+                    tolerance = atol + rtol * max(abs(prev), abs(curr))
+                    
+                    if error <= tolerance or b - a <= min_step:
+                        break
+                    
+                    h = max(min_step, (b - a) * max(0.2, 0.9 * np.sqrt(tolerance / error)))
+                    
+                # linear interpolation error scales with the square of the step
+                h = (b - a) * (5 if error == 0 else min(5, max(0.2, 0.9 * np.sqrt(tolerance / error))))
                 
-            return info
+                M_error = np.sqrt((1-np.exp(-2*patient.k_el*(b-a)))/(2*patient.k_el))
+                curr += self.noise.normal(0, np.sqrt(self.errors.dosage_timing) * M_error)
+                
+                self.record(b, curr, curr/patient.v_d)
+                prev = curr
+                
+                if self.therapy.is_measurement(b):
+                    self.measure(a, b, curr, dose, patient, D_error)
+                    
+        if reset:
+            return self.reset()
+        
+    def exact_step(self, a, b, prev, dose, patient):
+        ''' Advances the amount from a to b with the closed-form solution
+        
+            The step must not cross a dose boundary. Dosage errors are drawn the first
+            time a dosage interval is reached.
+            
+            Returns: 2-tuple of the amount at b and the dosage error of the step
+        '''
+        
+        if a > self.therapy.dosage_period * self.dosage_interval + self.therapy.dosage_length:
+            self.dosage_interval += 1
+            
+        while len(self.dosage_errors) <= self.dosage_interval:
+            percent_error = self.noise.normal(0, self.errors.dosage)
+            self.dosage_errors.append(percent_error)
+            
+        loss = np.exp(-patient.k_el*(b-a))
+        gain = dose * self.administer(a, b, patient)
+        D_error = gain * self.dosage_errors[self.dosage_interval]
+        
+        return prev*loss + gain + D_error, D_error
     
-    def administer(self, a, b, patient):
+    def measure(self, a, b, curr, dose, patient, D_error):
+        ''' Takes a noisy measurement of the amount curr at time b and updates the prior '''
+        
+        M_error = np.sqrt((1-np.exp(-2*patient.k_el*(b-a)))/(2*patient.k_el))
+        T_error = 1
+        
+        measurement_error = self.noise.normal(0, self.errors.measurement)
+        self.measurements.append(curr/patient.v_d + measurement_error)
+        
+        if self.updating:
+            self.priors.kalman_filter(a, b, dose, self.administer, M_error+D_error+T_error, self.measurements[-1], self.noise)
+    
+    def administer(self, a, b, patient, interval=None):
         # dose interval from tk to tk_star
-        tk = self.dosage_interval * self.therapy.dosage_period
+        if interval == None:
+            interval = self.dosage_interval
+
+        tk = interval * self.therapy.dosage_period
         tk_star = tk + self.therapy.dosage_length
+
+        return infusion_integral(a, b, tk, tk_star, patient.k_el)
+    
+    def simulate_cohort(self, step_size, stop_time, doses, k_el, v_d, seeds=None, precision=1):
+        ''' Simulates an entire cohort of patients in lockstep
         
-        # b is to the left of the dose interval
-        if b <= tk:
-            val = 0
+            step_size: Length in hours of each step as a numeric value
+            stop_time: Time in hours at which the simulation stops as a numeric value
+            doses: Dose given to each patient as an array of numeric values
+            k_el: Elimination constant of each patient as an array of numeric values
+            v_d: Volume of distribution of each patient as an array of numeric values
+            seeds: Seed of each patient's noise stream as an array of integers,
+                   row i matches reseed(seeds[i]) followed by
+                   simulate(step_size, stop_time, doses[i], reset=True)
+            precision: Number of digits the time steps are rounded to
+            
+            Returns: 3-tuple where
+                     the first element is the array of time steps
+                     the second element is the (n_patients, n_steps) array of amounts
+                     the third element is the (n_patients, n_steps) array of concentrations
+        '''
         
-        # a is outside dose interval, b is in dose interval
-        elif a < tk and b > tk:
-            val = (1-np.exp(-patient.k_el*(b-tk)))/patient.k_el
+        k_el = np.asarray(k_el, dtype=float)
+        v_d = np.asarray(v_d, dtype=float)
+        doses = np.broadcast_to(np.asarray(doses, dtype=float), k_el.shape)
         
-        # a and b are inside of dose interval
-        elif a >= tk and b <= tk_star:
-            val = (1-np.exp(-patient.k_el*(b-a)))/patient.k_el
+        if seeds is None:
+            seeds = self.noise.spawn_seeds(len(k_el))
         
-        # a is in dose interval, b is outside dose interval
-        elif a < tk_star and b > tk_star:
-            val = (np.exp(-patient.k_el*(b-a))-np.exp(-patient.k_el*(b-tk_star)))/patient.k_el
+        # lay out the random stream exactly as the scalar path consumes it:
+        # two draws per step up front, then the dosage errors and measurements,
+        # which are followed by the draws of the prior's update when it runs
+        update_draws = self.priors.update_draws if self.updating else 0
+        time_steps = [0]
+        intervals = []
+        error_draws = []
+        dosage_interval = 0
+        draws = 0
         
-        # a is to the right of the dose interval
-        else:
-            val = 0
-
-        return val
+        while time_steps[-1] < stop_time:
+            a = time_steps[-1]
+            b = round(a + step_size, precision)
+            
+            if a > self.therapy.dosage_period * dosage_interval + self.therapy.dosage_length:
+                dosage_interval += 1
+                
+            if len(error_draws) == dosage_interval:
+                error_draws.append(draws)
+                draws += 1
+                
+            intervals.append(dosage_interval)
+            
+            if self.therapy.is_measurement(b):
+                draws += 1 + update_draws
+                
+            time_steps.append(b)
+            
+        steps = len(intervals)
+        draws += 2 * steps
+        
+        noise = np.array([ NoiseStream(seed).standard_normal(draws) for seed in seeds ]).reshape(len(k_el), draws)
+        dosage_errors = self.errors.dosage * noise[:, np.add(error_draws, 2 * steps)]
+        w2 = self.errors.dosage * noise[:, 0:2 * steps:2]
+        w3 = self.errors.dosage_timing * noise[:, 1:2 * steps:2]
+        
+        amounts = np.zeros((len(k_el), len(time_steps)))
+        
+        for idx in range(1, len(time_steps)):
+            a = time_steps[idx - 1]
+            b = time_steps[idx]
+            interval = intervals[idx - 1]
+            
+            tk = interval * self.therapy.dosage_period
+            tk_star = tk + self.therapy.dosage_length
+            
+            loss = np.exp(-k_el*(b-a))
+            gain = doses * infusion_integral(a, b, tk, tk_star, k_el)
+            
+            M_error = np.sqrt((1-np.exp(-2*k_el*(b-a)))/(2*k_el))
+            D_error = gain * dosage_errors[:, interval]
+            T_error = 1
+            
+            amounts[:, idx] = amounts[:, idx - 1]*loss + gain + M_error + D_error*w2[:, idx - 1] + T_error*w3[:, idx - 1]
+            
+        return np.array(time_steps), amounts, amounts / v_d[:, np.newaxis]
     
-    def optimalInitialDose(self):
+    def optimalInitialDose(self, closed_form=False):
+        if closed_form:
+            doses = self.optimalDoses(self.priors.k_el, self.priors.v_d)
+            return np.sum(self.priors.weights * doses)
+        
         dose = 0
         
-        for i in range(len(self.priors.k_slopes)):
-            for j in range(len(self.priors.v_slopes)):
-                w, patient = self.priors.weights[i][j]
-                dose += w * self.optimalDose(patient)
+        for index in np.ndindex(self.priors.weights.shape):
+            w = self.priors.weights[index]
+            dose += w * self.optimalDose(self.priors.patient_at(*index))
      
         return dose
     
+    def optimalDoses(self, k_el, v_d):
+        ''' Solves for the least-squares peak/trough dose in closed form
+        
+            k_el: Elimination constants as a numeric value or an array of numeric values
+            v_d: Volumes of distribution as a numeric value or an array of numeric values
+            
+            Concentration is linear in dose, so with the peak taken at the end of the
+            first infusion and the trough an hour before the next dose (as in optimalDose)
+            the dose minimizing (peak - goal)^2 + (trough - goal)^2 has a closed form.
+            
+            Returns: Optimal dose for every pair of parameters as an array
+        '''
+        
+        k_el = np.asarray(k_el, dtype=float)
+        v_d = np.asarray(v_d, dtype=float)
+        
+        length = self.therapy.dosage_length
+        trough_time = self.therapy.dosage_period - 1
+        
+        # concentration per unit dose at the peak and at the trough
+        beta_peak = (1-np.exp(-k_el*length))/(k_el*v_d)
+        beta_trough = beta_peak * np.exp(-k_el*(trough_time-length))
+        
+        numer = beta_peak*self.therapy.peak + beta_trough*self.therapy.trough
+        denom = beta_peak**2 + beta_trough**2
+        
+        return numer / denom
+    
+    def newtonDose(self, times=None, goals=None, patient=None):
+        ''' Dose minimizing the squared distance to the goals at the given times, in one Newton step
+        
+            times: Times in hours of the goals as a list of numeric values, the peak and trough of
+                   optimalDose by default
+            goals: Concentration goal at each time as a list of numeric values, given together with times
+            patient: Patient or PatientBatch to dose, the prior's expected loss is minimized if None
+            
+            Concentration is linear in dose, so the Newton step from a zero dose lands on the
+            minimum exactly using the analytic derivatives of concentration_gradient.
+        '''
+        
+        if (times is None) != (goals is None):
+            raise ValueError('times and goals must be given together')
+            
+        if times is None:
+            times = [self.therapy.dosage_length, self.therapy.dosage_period - 1]
+            goals = [self.therapy.peak, self.therapy.trough]
+            
+        if patient == None:
+            k_el, v_d, weights = self.priors.k_el, self.priors.v_d, self.priors.weights
+            
+        else:
+            k_el, v_d, weights = patient.k_el, patient.v_d, 1
+            
+        times = np.asarray(times, dtype=float)
+        goals = np.asarray(goals, dtype=float)
+        
+        if times.shape != goals.shape:
+            raise ValueError('Got {} times for {} goals'.format(len(times), len(goals)))
+        
+        # times along the last axis, patients or grid points along the others
+        _, conc_dose, _, _ = concentration_gradient(times, 1, np.asarray(k_el)[..., np.newaxis], np.asarray(v_d)[..., np.newaxis],
+                                                     self.therapy.dosage_period, self.therapy.dosage_length)
+        
+        gradient = -2 * np.sum(weights * np.sum(conc_dose * goals, axis=-1))
+        hessian = 2 * np.sum(weights * np.sum(conc_dose**2, axis=-1))
+        
+        return -gradient / hessian
+    
+    def laplacePosterior(self, measurement_times=None, measurements=None, dose=None, measurement_variance=1, max_iter=50, tol=1e-10):
+        ''' Gaussian approximation of the posterior over the patient's Kslope and Vslope
+        
+            measurement_times: Times of the measurements, the therapy's by default
+            measurements: Measured concentrations, the simulator's by default
+            dose: Dose given at each dosage interval, the simulator's by default
+            measurement_variance: Variance of the measurement error as a numeric value
+            max_iter: Maximum number of Gauss-Newton iterations as an integer
+            tol: Step size in standardized units below which the mode is considered found
+            
+            The prior is replaced by the Gaussian with its weighted mean and covariance, and the
+            mode is found with Gauss-Newton steps on the analytic Jacobian of the concentrations.
+            
+            Returns: 2-tuple where
+                     the first element is the posterior mode as an array of (Kslope, Vslope)
+                     the second element is the 2x2 covariance at the mode
+        '''
+        
+        if measurements is None:
+            measurements = self.measurements
+            
+        if measurement_times is None:
+            measurement_times = self.therapy.measurement_times[:len(measurements)]
+            
+        if dose == None:
+            dose = self.dose
+            
+        y = np.asarray(measurements, dtype=float)
+        t = np.asarray(measurement_times, dtype=float)
+        
+        if t.shape != y.shape:
+            raise ValueError('Got {} measurement times for {} measurements'.format(len(t), len(y)))
+            
+        patient = self.patient
+        
+        # Gaussian moments of the prior over (Kslope, Vslope)
+        weights = np.ravel(self.priors.weights)
+        samples = np.stack((np.broadcast_to(self.priors.patients.k_slope, self.priors.patients.shape).ravel(),
+                            np.broadcast_to(self.priors.patients.v_slope, self.priors.patients.shape).ravel()))
+        prior_mean = samples @ weights
+        prior_cov = np.atleast_2d(np.cov(samples, aweights=weights, bias=True)) + 1e-12*np.eye(2)
+        prior_precision = np.linalg.inv(prior_cov)
+        
+        scale = np.array([patient.cl_cr, patient.bw])
+        theta = prior_mean.copy()
+        
+        for _ in range(max_iter):
+            k_el = patient.k_int + theta[0]*patient.cl_cr
+            v_d = theta[1]*patient.bw
+            
+            conc, _, conc_k, conc_v = concentration_gradient(t, dose, k_el, v_d, self.therapy.dosage_period, self.therapy.dosage_length)
+            jacobian = np.stack((conc_k, conc_v), axis=-1) * scale
+            
+            hessian = jacobian.T @ jacobian / measurement_variance + prior_precision
+            gradient = jacobian.T @ (conc - y) / measurement_variance + prior_precision @ (theta - prior_mean)
+            
+            step = np.linalg.solve(hessian, gradient)
+            theta = theta - step
+            
+            if step @ hessian @ step < tol:
+                break
+            
+        return theta, np.linalg.inv(hessian)
+    
+    def reseed(self, seed):
+        ''' Restarts the simulator's noise stream from seed '''
+        
+        self.noise = NoiseStream(seed, self.noise.block_size)
+    
+    def setTherapy(self, therapy):
+        ''' Switches to a new therapy and drops doses cached for the old one '''
+        
+        if self.cache != None:
+            self.cache.invalidate(self.therapy)
+            
+        self.therapy = therapy
+    
     def optimalDose(self, patient, tolerance=0.01, step=0.1, max_iter=50):
+        if self.cache != None:
+            key = self.cache.key(patient, self.therapy, tolerance, step, max_iter)
+            dose = self.cache.get(key)
+            
+            if dose == None:
+                dose = self._optimalDose(patient, tolerance, step, max_iter)
+                self.cache.put(key, dose)
+                
+            return dose
+        
+        return self._optimalDose(patient, tolerance, step, max_iter)
+    
+    def _optimalDose(self, patient, tolerance, step, max_iter):
+        updating = self.updating
+        self.updating = False
+        
+        try:
+            return self.bisectDose(patient, tolerance, step, max_iter)
+        
+        finally:
+            self.updating = updating
+            
+    def bisectDose(self, patient, tolerance, step, max_iter):
         minimum_dose = 0
         maximum_dose = 3000
 
@@ -290,8 +1162,8 @@ class PKSimulator:
                                        patient=patient,
                                        reset=True)
             
-            peak = zs[ts.index(self.therapy.dosage_length)]
-            trough = zs[ts.index(self.therapy.dosage_period-1)]
+            peak = zs[find_time(ts, self.therapy.dosage_length)]
+            trough = zs[find_time(ts, self.therapy.dosage_period-1)]
             
             if peak >= self.therapy.peak and trough >= self.therapy.trough:
                 maximum_dose = curr
@@ -316,25 +1188,203 @@ class PKSimulator:
 
         return curr
     
-    def graph(self):
-        plt.xlabel('Time (hours)')
-        plt.ylabel('Concentration (mg/L)')
+    def graph(self, time_steps=None, concentration_steps=None, measurement_times=None, measurements=None, path=None, max_points=2000):
+        ''' Plots a run, the simulator's own unless arrays (such as TrajectoryStore.run columns) are given 
+        
+            path: File the figure is written to without a display, shown with pyplot if None
+            max_points: Number of points the trajectory is decimated to, every point if None
+        '''
+        
+        if time_steps is None:
+            time_steps, concentration_steps = self.time_steps, self.concentration_steps
+            
+        if measurements is None:
+            measurements = self.measurements
+            measurement_times = self.therapy.measurement_times[:len(measurements)]
+            
+        ax = new_axes() if path != None else plt.gca()
         
-        plt.axhline(self.therapy.peak, color='r', label='Goal Concentrations')
-        plt.axhline(self.therapy.trough, color='r')
+        ax.set_xlabel('Time (hours)')
+        ax.set_ylabel('Concentration (mg/L)')
         
-        plt.plot(self.time_steps, self.concentration_steps, label='True Concentration')
+        ax.axhline(self.therapy.peak, color='r', label='Goal Concentrations')
+        ax.axhline(self.therapy.trough, color='r')
         
-        plt.plot(self.therapy.measurement_times, self.measurements, 'ro', label='Noisy Measurements')
+        draw_trajectory(ax, time_steps, concentration_steps, max_points=max_points, label='True Concentration')
         
-        plt.legend()
-        plt.show()
+        ax.plot(measurement_times, measurements, 'ro', label='Noisy Measurements')
         
+        ax.legend()
+        
+        if path != None:
+            ax.figure.savefig(path)
+            
+        else:
+            plt.show()
+        
+def find_time(time_steps, t):
+    ''' Index of time t in a sorted array of time steps, raising ValueError if absent '''
+    
+    idx = np.searchsorted(time_steps, t)
+    
+    if idx == len(time_steps) or time_steps[idx] != t:
+        raise ValueError('{} is not a time step'.format(t))
+        
+    return idx
+
+def infusion_integral(a, b, tk, tk_star, k_el):
+    ''' Integral over [a, b] of a unit infusion running from tk to tk_star
+    
+        k_el: Elimination constant as a numeric value or an array of numeric values
+    '''
+    
+    # b is to the left of the dose interval
+    if b <= tk:
+        val = 0
+    
+    # a is outside dose interval, b is in or past the dose interval
+    elif a < tk and b > tk:
+        val = (np.exp(-k_el*(b-min(b, tk_star)))-np.exp(-k_el*(b-tk)))/k_el
+    
+    # a and b are inside of dose interval
+    elif a >= tk and b <= tk_star:
+        val = (1-np.exp(-k_el*(b-a)))/k_el
+    
+    # a is in dose interval, b is outside dose interval
+    elif a < tk_star and b > tk_star:
+        val = (np.exp(-k_el*(b-tk_star))-np.exp(-k_el*(b-a)))/k_el
+    
+    # a is to the right of the dose interval
+    else:
+        val = 0
+
+    return val
+
+def superposition(times, k_el, dosage_period, dosage_length):
+    ''' Amount in the body per unit dose and its derivative in k_el, summed over every dose given
+    
+        times: Times in hours as a numeric value or an array
+        k_el: Elimination constants broadcastable against times
+        dosage_period: Length in hours between each dose given as a numeric value
+        dosage_length: Length of dose in hours as a numeric value
+    
+        Each dose contributes (exp(-k_el*u) - exp(-k_el*s))/k_el, where s is the time since
+        it started and u the time since it ended, so doses still running have u = 0.
+    
+        Returns: 2-tuple of arrays shaped like times and k_el broadcast together where
+                 the first element holds the amounts per unit dose
+                 the second element holds their derivatives in k_el
+    '''
+    
+    times = np.asarray(times, dtype=float)
+    k_el = np.asarray(k_el, dtype=float)[..., np.newaxis]
+    
+    doses = int(np.max(times, initial=0) // dosage_period) + 1
+    s = times[..., np.newaxis] - dosage_period * np.arange(doses)
+    given = s > 0
+    
+    s = np.where(given, s, 0)
+    u = np.maximum(s - dosage_length, 0)
+    
+    decay_u = np.exp(-k_el*u)
+    decay_s = np.exp(-k_el*s)
+    
+    amount = np.where(given, (decay_u - decay_s)/k_el, 0)
+    gradient = np.where(given, (s*decay_s - u*decay_u)/k_el - amount/k_el, 0)
+    
+    return amount.sum(axis=-1), gradient.sum(axis=-1)
+
+def concentration_gradient(t, dose, k_el, v_d, dosage_period, dosage_length):
+    ''' Noise-free concentration at times t and its derivatives, for every dose given so far
+    
+        t: Times in hours as a numeric value or an array
+        dose: Dose given at each dosage interval, broadcastable against t
+        k_el: Elimination constants, broadcastable against t
+        v_d: Volumes of distribution, broadcastable against t
+        dosage_period: Length in hours between each dose given as a numeric value
+        dosage_length: Length of dose in hours as a numeric value
+        
+        Follows the model of simulate_events without noise, so the derivatives are exact
+        and a Newton step needs no re-simulation.
+        
+        Returns: 4-tuple of arrays broadcast from the inputs where
+                 the first element holds the concentrations
+                 the second element holds their derivatives in dose
+                 the third element holds their derivatives in k_el
+                 the fourth element holds their derivatives in v_d
+    '''
+    
+    amount, amount_k = superposition(t, k_el, dosage_period, dosage_length)
+    v_d = np.asarray(v_d, dtype=float)
+    
+    conc_dose = amount / v_d
+    conc = dose * conc_dose
+    
+    return conc, np.broadcast_to(conc_dose, conc.shape), dose * amount_k / v_d, -conc / v_d
+
+def time_grid(start, step_size, stop_time, precision=1):
+    ''' Times from start in steps of step_size, rounded to precision digits, up to the first one at or past stop_time
+    
+        Each time is rounded from start + i*step_size rather than from the previous one, which
+        gives the same times as stepping one at a time when step_size has at most precision digits.
+        
+        Returns: Array of times beginning with start
+    '''
+    
+    # one spare step covers rounding in the estimate of the count
+    count = max(int(np.ceil((stop_time - start) / step_size)), 0) + 1
+    grid = np.round(start + step_size*np.arange(count + 1), precision)
+    grid[0] = start
+    
+    return grid[:np.searchsorted(grid, stop_time) + 1]
+    
+def check_gradients(t, dose, k_el, v_d, dosage_period, dosage_length, h=1e-6):
+    ''' Largest relative gap between concentration_gradient and central finite differences
+    
+        Takes the parameters of concentration_gradient, h being the relative step.
+        
+        Returns: Dictionary of the gaps for dose, k_el and v_d
+    '''
+    
+    params = { 'dose': np.asarray(dose, dtype=float), 'k_el': np.asarray(k_el, dtype=float), 'v_d': np.asarray(v_d, dtype=float) }
+    conc = lambda **changed: concentration_gradient(t, dosage_period=dosage_period, dosage_length=dosage_length, **dict(params, **changed))
+    
+    analytic = dict(zip(('dose', 'k_el', 'v_d'), conc()[1:]))
+    gaps = {}
+    
+    for name, value in params.items():
+        step = h * np.maximum(np.abs(value), 1)
+        numeric = (conc(**{name: value + step})[0] - conc(**{name: value - step})[0]) / (2*step)
+        
+        gaps[name] = float(np.max(np.abs(numeric - analytic[name]) / np.maximum(np.abs(numeric), 1e-12)))
+        
+    return gaps
+
 def sample_k_slopes(num, p, mean1, stdev1, mean2, stdev2):
     return np.random.normal(mean1, stdev1, num) if np.random.uniform() >= p else np.random.normal(mean2, stdev2, num)
 
 def sample_v_slopes(num, mean, stdev):
     return np.random.normal(mean, stdev, num)
+
+def sample_population(rng, num, k_slope_params, v_slope_params):
+    ''' Draws the Kslopes and Vslopes of num patients from the population distributions
+    
+        rng: np.random.Generator the draws come from
+        k_slope_params: Kslope mixture as (p, mean1, stdev1, mean2, stdev2), as consumed by sample_k_slopes
+        v_slope_params: Vslope distribution as (mean, stdev), as consumed by sample_v_slopes
+        
+        Unlike sample_k_slopes, the mixture component is drawn per patient.
+        
+        Returns: 2-tuple of arrays of Kslopes and Vslopes
+    '''
+    
+    p, mean1, stdev1, mean2, stdev2 = k_slope_params
+    mean, stdev = v_slope_params
+    
+    second = rng.uniform(size=num) < p
+    k_slopes = np.where(second, rng.normal(mean2, stdev2, num), rng.normal(mean1, stdev1, num))
+    
+    return k_slopes, rng.normal(mean, stdev, num)
     
 if __name__ == '__main__':
     plt.rcParams['figure.figsize'] = (10, 8)
@@ -5,6 +5,9 @@ import matplotlib.pyplot as plt
 import numpy as np
 import scipy.stats as st
 
+from scipy.special import logsumexp
+from PKplotting import draw_trajectory, new_axes
+
 class DrugSimulator:
     def __init__(self, goals, k_slopes, v_slopes, known_params, unknown_params, dosage_period, duration, measurement_times):
         # set peak and trough goals
@@ -30,6 +33,9 @@ class DrugSimulator:
         self.measurement_times = measurement_times
         # the times that the doses will be administered
         self.dose_times = list(filter(lambda t: t % self.dosage_period == 0, range(duration)))
+        self.dose_array = np.array(self.dose_times, dtype=float)
+        # log cumulative sums of exp(k*dose_time) keyed by elimination rate
+        self.dose_sums = {}
         # where taken measurements will be stored
         self.measurements = []
 
@@ -43,98 +49,110 @@ class DrugSimulator:
     def initialize_prior(self):
         ''' Initializes our Bayesian prior '''
 
-        # create a matrix of zeroes
-        prior = [ [ 0 for i in range(len(self.v_slopes)) ] for j in range(len(self.k_slopes)) ]
+        # the prior is a triple of matrices holding the log weight,
+        # the elimination rate and the volume of distribution of each model
+        shape = (len(self.k_slopes), len(self.v_slopes))
+        k = np.broadcast_to((np.asarray(self.k_slopes) * self.cl_cr + self.k_int)[:, np.newaxis], shape)
+        v = np.broadcast_to((np.asarray(self.v_slopes) * self.bw)[np.newaxis, :], shape)
         # initially set each model to have the same weight
         # TODO: initialize each model to have a distinct weight
-        w = 1/(len(self.k_slopes) * len(self.v_slopes))
-        
-        for i in range(len(prior)):
-            for j in range(len(prior[0])):
-                # set each element of the matrix to triples
-                # each containing the weight, the elimination rate
-                # and the volume of distribution
-                prior[i][j] = (w, self.k_slopes[i]*self.cl_cr+self.k_int, self.v_slopes[j]*self.bw)
+        log_w = np.full(shape, -np.log(shape[0] * shape[1]))
 
-        return prior
+        return log_w, k.copy(), v.copy()
 
     def initialize_dosage(self, tp, tt):
         ''' Calculates the optimal initial dosage '''
 
-        dose = 0
-
-        for i in range(len(self.prior)):
-            for j in range(len(self.prior[0])):
-                # unpack the values of the triple
-                w, k, v = self.prior[i][j]
-
-                # add the weighted dose to the total sum
-                dose += self.optimal_dose(tp, tt, k, v, 0) * w
+        log_w, k, v = self.prior
 
-        return dose
+        # weighted sum of the optimal dose of every model
+        return np.sum(np.exp(log_w) * self.optimal_dose(tp, tt, k, v, 0))
 
     def optimal_dose(self, tp, tt, k, v, init):
         ''' Calculates the optimal dosage for a set of parameters '''
 
         alpha = lambda t: init*np.exp(-k*t)/v
-        beta = lambda t: sum([ heaviside(t-dose_time)*np.exp(-k*(t-dose_time)) for dose_time in self.dose_times ])/v
+        beta = lambda t: self.dose_sum(t, k)/v
         numer = beta(tp)*(self.y_peak-alpha(tp))+beta(tt)*(self.y_trough-alpha(tt))
         denom = beta(tp)**2 + beta(tt)**2
         return numer / denom
 
-    def solution(self, t, k, v, init=None):
-        ''' Yields concentration at time t given parameters k and v '''
+    def log_dose_sums(self, k):
+        ''' Log cumulative sums of exp(k*dose_time) over the dose history
 
-        total = init if init else self.init
+            Element i sums the first i doses, so element 0 is -inf. Sums are kept in
+            log space so long horizons do not overflow, and are cached for scalar k.
+        '''
 
-        for dose_time in self.dose_times:
-            total += self.current_dosage * heaviside(t - dose_time) * np.exp(k * dose_time)
+        if np.ndim(k) == 0 and k in self.dose_sums:
+            return self.dose_sums[k]
 
-            if t < dose_time:
-                break
+        exponents = np.multiply.outer(k, self.dose_array)
+        sums = np.logaddexp.accumulate(exponents, axis=-1)
+        sums = np.concatenate((np.full(np.shape(k) + (1,), -np.inf), sums), axis=-1)
 
-        return np.exp(-k * t) * total / v
+        if np.ndim(k) == 0:
+            self.dose_sums[k] = sums
 
-    def update_prior(self, t):
-        total = 0
-        
-        for i, row in enumerate(self.prior):
-            for j, elem in enumerate(row):
-                w, k, v = elem
+        return sums
+
+    def dose_sum(self, t, k):
+        ''' Sum of exp(-k*(t-dose_time)) over doses given by time t
 
-                patient_peak = self.solution(t, self.k_el, self.v_d)
-                parameter_peak = self.solution(t, k, v)
+            Either t or k may be an array; the doses given by t are found by binary search.
+        '''
 
-                peak_observation = patient_peak + np.random.normal(0, 0.3)
+        given = np.searchsorted(self.dose_array, t, side='right')
+        sums = self.log_dose_sums(k)
 
-                patient_trough = self.solution(t + self.dosage_period - 1, self.k_el, self.v_d)
-                parameter_trough = self.solution(t + self.dosage_period - 1, k, v)
+        return np.exp(np.take(sums, given, axis=-1) - np.multiply(k, t))
 
-                trough_observation = patient_trough + np.random.normal(0, 0.3)
+    def solution(self, t, k, v, init=None):
+        ''' Yields concentration at time t given parameters k and v
 
-                w *= st.norm.pdf(peak_observation, parameter_peak, 0.3)
-                w *= st.norm.pdf(trough_observation, parameter_trough, 0.3)
+            t may be an array of times, giving the whole trajectory at once.
+        '''
 
-                self.prior[i][j] = (w, k, v)
-                total += w
+        total = init if init else self.init
+
+        return (np.exp(-k * t) * total + self.current_dosage * self.dose_sum(t, k)) / v
+
+    def update_prior(self, t):
+        ''' Weighs every model by a noisy peak and trough observation of the patient '''
 
-        for i in range(len(self.prior)):
-            for j in range(len(self.prior[0])):
-                w, k, v = self.prior[i][j]
-                self.prior[i][j] = (w/total, k, v)
+        log_w, k, v = self.prior
+
+        # the observations are the same for every model
+        patient_peak = self.solution(t, self.k_el, self.v_d)
+        peak_observation = patient_peak + np.random.normal(0, 0.3)
+
+        patient_trough = self.solution(t + self.dosage_period - 1, self.k_el, self.v_d)
+        trough_observation = patient_trough + np.random.normal(0, 0.3)
+
+        parameter_peak = self.solution(t, k, v)
+        parameter_trough = self.solution(t + self.dosage_period - 1, k, v)
+
+        log_w = log_w + st.norm.logpdf(peak_observation, parameter_peak, 0.3)
+        log_w = log_w + st.norm.logpdf(trough_observation, parameter_trough, 0.3)
+
+        self.prior = (log_w - logsumexp(log_w), k, v)
 
     def simulate(self, k, v, step):
         self.init = 0
         self.measurements = []
-        timesteps = [ i*step for i in range(int(self.duration/step)) ]
+        timesteps = np.arange(int(self.duration/step)) * step
         #time_perturbations = [ np.random.normal() for ]
         steps = [[0]]
         vals = [[0]]
 
-        for step in timesteps:
-            #val = self.solution(step, k, v, self.init)
+        # measurements split the run into segments solved in one call each
+        hits = set(np.flatnonzero(np.isin(timesteps, self.measurement_times)).tolist())
+        bounds = sorted(hits | {0}) + [len(timesteps)]
+
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            step = timesteps[start]
 
-            if step in self.measurement_times:
+            if start in hits:
                 self.update_prior(step)
                 self.current_dosage = self.initialize_dosage(step, step+11)
                 #self.current_dosage = self.initialize_dosage(step-12, step-1)
@@ -152,28 +170,38 @@ class DrugSimulator:
                 print('Changed dosage at time {}.'.format(step))
                 print(self.current_dosage)
 
-            steps[-1].append(step)
-            #vals[-1].append(val)
-            vals[-1].append(self.solution(step, k, v, self.init))
+            segment = timesteps[start:stop]
+            steps[-1].extend(segment.tolist())
+            vals[-1].extend(self.solution(segment, k, v, self.init).tolist())
 
         return steps, vals
 
-    def graph(self, k, v, step):
+    def graph(self, k, v, step, path=None, max_points=2000):
+        ''' Plots a run, alternating colors between dosage segments
+
+            path: File the figure is written to without a display, shown with pyplot if None
+            max_points: Number of points each segment is decimated to, every point if None
+        '''
+
         self.prior = self.initialize_prior()
         self.current_dosage = self.initialize_dosage(0, 11)
         ts, ys = self.simulate(k, v, step)
-        time = []
+
+        ax = new_axes() if path != None else plt.gca()
+
         for i in range(len(ts)):
-            plt.plot(ts[i], ys[i], 'C0' if i%2==0 else 'C1')
-            time = time + ts[i]
-
-        peak = [ self.y_peak for t in time ]
-        trough = [ self.y_trough for t in time ]
-        plt.plot(time, peak, 'C3')
-        plt.plot(time, trough, 'C3')
-        plt.xlabel('Time (Hours)')
-        plt.ylabel('Drug Concentration (mg/L)')
-        plt.show()
+            draw_trajectory(ax, ts[i], ys[i], 'C0' if i%2==0 else 'C1', max_points=max_points)
+
+        ax.axhline(self.y_peak, color='C3')
+        ax.axhline(self.y_trough, color='C3')
+        ax.set_xlabel('Time (Hours)')
+        ax.set_ylabel('Drug Concentration (mg/L)')
+
+        if path != None:
+            ax.figure.savefig(path)
+
+        else:
+            plt.show()
         
 
 def heaviside(t):
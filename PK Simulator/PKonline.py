@@ -0,0 +1,153 @@
+import numpy as np
+import threading
+
+from PKcontinuous import infusion_integral
+
+class DosingSession:
+    ''' Class for recommending doses for one patient as events arrive '''
+
+    def __init__(self, posterior, therapy, measurement_variance=1):
+        ''' Creates DosingSession object
+
+            posterior: Prior or ParticlePosterior giving the parameters and initial weights
+            therapy: Therapy whose period, infusion length and goals drive the recommendation
+            measurement_variance: Variance of the concentration measurements as a numeric value
+        '''
+
+        self.k_el = np.ravel(posterior.k_el)
+        self.v_d = np.ravel(posterior.v_d)
+        self.log_weights = np.log(np.ravel(posterior.weights))
+        self.therapy = therapy
+        self.measurement_variance = measurement_variance
+
+        # predicted amount of every grid point at self.time
+        self.time = 0
+        self.amounts = np.zeros(len(self.k_el))
+
+        # infusions as (start, stop, dose) that have not finished by self.time
+        self.infusions = []
+        self.last_dose_time = None
+
+    @property
+    def weights(self):
+        return np.exp(self.log_weights)
+
+    def advance(self, time):
+        ''' Moves every grid point's predicted amount forward to time '''
+
+        if time < self.time:
+            raise ValueError('Events must arrive in time order, got {} after {}'.format(time, self.time))
+
+        self.amounts = self.amounts*np.exp(-self.k_el*(time - self.time))
+
+        for start, stop, dose in self.infusions:
+            self.amounts += dose*infusion_integral(self.time, time, start, stop, self.k_el)
+
+        self.infusions = [ infusion for infusion in self.infusions if infusion[1] > time ]
+        self.time = time
+
+    def add_dose(self, time, dose, length=None):
+        ''' Records an infusion of dose starting at time, lasting the therapy's dosage length by default
+
+            Returns: Recommended next dose as a numeric value
+        '''
+
+        self.advance(time)
+
+        length = length if length != None else self.therapy.dosage_length
+        self.infusions.append((time, time + length, dose))
+        self.last_dose_time = time
+
+        return self.recommend()
+
+    def add_measurement(self, time, concentration):
+        ''' Weighs every grid point by a measured concentration
+
+            Returns: Recommended next dose as a numeric value
+        '''
+
+        self.advance(time)
+
+        residual = concentration - self.amounts/self.v_d
+        self.log_weights -= 0.5*residual**2/self.measurement_variance
+        self.log_weights -= np.logaddexp.reduce(self.log_weights)
+
+        return self.recommend()
+
+    def next_dose_time(self):
+        ''' Time of the next scheduled dose, now if nothing has been given '''
+
+        if self.last_dose_time == None:
+            return self.time
+
+        return max(self.time, self.last_dose_time + self.therapy.dosage_period)
+
+    def carry_over(self, t):
+        ''' Predicted amount of every grid point at time t without further doses '''
+
+        amounts = self.amounts*np.exp(-self.k_el*(t - self.time))
+
+        for start, stop, dose in self.infusions:
+            amounts += dose*infusion_integral(self.time, t, start, stop, self.k_el)
+
+        return amounts
+
+    def recommend(self):
+        ''' Least-squares peak/trough dose for the next infusion averaged over the posterior
+
+            The peak is taken at the end of the infusion and the trough an hour before
+            the following dose, as in PKSimulator.optimalDose, with the drug already on
+            board carried over.
+        '''
+
+        start = self.next_dose_time()
+        length = self.therapy.dosage_length
+        peak_time = start + length
+        trough_time = start + self.therapy.dosage_period - 1
+
+        alpha_peak = self.carry_over(peak_time)/self.v_d
+        alpha_trough = self.carry_over(trough_time)/self.v_d
+
+        beta_peak = (1-np.exp(-self.k_el*length))/(self.k_el*self.v_d)
+        beta_trough = beta_peak*np.exp(-self.k_el*(trough_time-peak_time))
+
+        numer = beta_peak*(self.therapy.peak - alpha_peak) + beta_trough*(self.therapy.trough - alpha_trough)
+        denom = beta_peak**2 + beta_trough**2
+
+        return max(np.sum(self.weights*numer/denom), 0)
+
+class DosingService:
+    ''' Class for serving dosing sessions of many patients from one process '''
+
+    def __init__(self):
+        self.sessions = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def open(self, patient_id, posterior, therapy, measurement_variance=1):
+        ''' Starts a session for patient_id and returns the initial recommendation '''
+
+        session = DosingSession(posterior, therapy, measurement_variance)
+
+        with self.lock:
+            self.sessions[patient_id] = session
+            self.locks[patient_id] = threading.Lock()
+
+        return session.recommend()
+
+    def close(self, patient_id):
+        with self.lock:
+            self.locks.pop(patient_id)
+            return self.sessions.pop(patient_id)
+
+    def add_dose(self, patient_id, time, dose, length=None):
+        ''' Returns the recommended next dose for patient_id '''
+
+        with self.locks[patient_id]:
+            return self.sessions[patient_id].add_dose(time, dose, length)
+
+    def add_measurement(self, patient_id, time, concentration):
+        ''' Returns the recommended next dose for patient_id '''
+
+        with self.locks[patient_id]:
+            return self.sessions[patient_id].add_measurement(time, concentration)
@@ -0,0 +1,174 @@
+import numpy as np
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+
+def minmax_indices(values, max_points):
+    ''' Indices keeping the minimum and maximum of each of max_points // 2 equal buckets
+
+        values: Samples along the last axis, one row per trajectory for 2-D arrays
+        max_points: Number of points kept per trajectory as an integer
+
+        Spikes survive because every bucket keeps both extremes, in time order.
+
+        Returns: Array of indices shaped like values with max_points along the last axis,
+                 or every index if there are already few enough points
+    '''
+
+    values = np.asarray(values, dtype=float)
+    n = values.shape[-1]
+
+    if n <= max_points:
+        return np.broadcast_to(np.arange(n), values.shape)
+
+    buckets = max(max_points // 2, 1)
+    edges = np.linspace(0, n, buckets + 1).astype(int)
+    size = np.diff(edges).max()
+
+    # buckets padded to the same size and masked, so every row is reduced at once
+    index = edges[:-1, np.newaxis] + np.arange(size)
+    valid = index < edges[1:, np.newaxis]
+    padded = np.where(valid, values[..., np.minimum(index, n - 1)], np.nan)
+
+    low = np.take_along_axis(np.broadcast_to(index, padded.shape), np.nanargmin(padded, axis=-1)[..., np.newaxis], -1)
+    high = np.take_along_axis(np.broadcast_to(index, padded.shape), np.nanargmax(padded, axis=-1)[..., np.newaxis], -1)
+
+    pairs = np.sort(np.concatenate((low, high), axis=-1), axis=-1)
+
+    return pairs.reshape(values.shape[:-1] + (2 * buckets,))
+
+def lttb_indices(x, y, max_points):
+    ''' Indices chosen by largest-triangle-three-buckets downsampling
+
+        x: Sorted sample times as an array
+        y: Samples as an array
+        max_points: Number of points kept as an integer, at least 3
+
+        The first and last points are kept, and each bucket in between keeps the point
+        forming the largest triangle with the previous pick and the next bucket's mean.
+
+        Returns: Sorted array of indices
+    '''
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+
+    if n <= max_points or max_points < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, max_points - 1).astype(int)
+
+    keep = np.empty(max_points, dtype=int)
+    keep[0] = 0
+    keep[-1] = n - 1
+
+    a = 0
+
+    for i in range(max_points - 2):
+        start, stop = edges[i], edges[i + 1]
+
+        if i == max_points - 3:
+            mean_x, mean_y = x[-1], y[-1]
+
+        else:
+            mean_x, mean_y = x[stop:edges[i + 2]].mean(), y[stop:edges[i + 2]].mean()
+
+        area = np.abs((x[a] - mean_x) * (y[start:stop] - y[a]) - (x[a] - x[start:stop]) * (mean_y - y[a]))
+        a = start + int(np.argmax(area))
+        keep[i + 1] = a
+
+    return keep
+
+def decimate(x, y, max_points, method='lttb'):
+    ''' Downsamples one trajectory to at most max_points points
+
+        method: 'lttb' to follow the shape, or 'minmax' to keep every bucket's extremes
+
+        Returns: 2-tuple of the kept times and samples as arrays
+    '''
+
+    x = np.asarray(x)
+    y = np.asarray(y)
+
+    if max_points == None:
+        return x, y
+
+    if method == 'lttb':
+        index = lttb_indices(x, y, max_points)
+
+    elif method == 'minmax':
+        index = minmax_indices(y, max_points)
+
+    else:
+        raise ValueError('Unknown decimation method {}'.format(method))
+
+    return x[index], y[index]
+
+def new_axes():
+    ''' Axes on a figure drawn by the Agg canvas, kept out of pyplot's figure manager '''
+
+    figure = Figure()
+    FigureCanvasAgg(figure)
+
+    return figure.add_subplot()
+
+def draw_trajectory(ax, x, y, *args, max_points=2000, method='lttb', **kwargs):
+    ''' Plots one decimated trajectory on ax, taking plot's remaining arguments '''
+
+    x, y = decimate(x, y, max_points, method)
+
+    return ax.plot(x, y, *args, **kwargs)
+
+def draw_cohort(ax, time_steps, concentrations, max_points=None, **kwargs):
+    ''' Draws every row of concentrations as a single LineCollection on ax
+
+        time_steps: Time steps shared by every trajectory as an array
+        concentrations: (n_patients, n_steps) array, as returned by simulate_cohort
+        max_points: Number of points kept per trajectory with min/max decimation,
+                    defaults to two per pixel of the axes' width
+
+        Takes the keyword arguments of LineCollection, such as colors, linewidths and alpha.
+    '''
+
+    time_steps = np.asarray(time_steps, dtype=float)
+    concentrations = np.atleast_2d(np.asarray(concentrations, dtype=float))
+
+    if max_points == None:
+        max_points = 2 * int(np.ceil(ax.bbox.width))
+
+    index = minmax_indices(concentrations, max_points)
+    segments = np.stack((time_steps[index], np.take_along_axis(concentrations, index, -1)), axis=-1)
+
+    lines = LineCollection(segments, **kwargs)
+    ax.add_collection(lines)
+    ax.autoscale_view()
+
+    return lines
+
+def plot_cohort(path, time_steps, concentrations, peak=None, trough=None, max_points=None, **kwargs):
+    ''' Writes a cohort overlay to path without a display
+
+        peak: Peak therapeutic goal drawn as a horizontal line, if given
+        trough: Trough therapeutic goal drawn as a horizontal line, if given
+
+        Takes the keyword arguments of draw_cohort.
+    '''
+
+    kwargs.setdefault('alpha', 0.2)
+    kwargs.setdefault('linewidths', 0.5)
+
+    ax = new_axes()
+    ax.set_xlabel('Time (hours)')
+    ax.set_ylabel('Concentration (mg/L)')
+
+    draw_cohort(ax, time_steps, concentrations, max_points, **kwargs)
+
+    for goal in (peak, trough):
+        if goal != None:
+            ax.axhline(goal, color='r')
+
+    ax.figure.savefig(path)
+
+    return ax.figure
@@ -0,0 +1,261 @@
+import numpy as np
+
+from PKcontinuous import concentration_gradient
+
+def fit_mixture(values, iterations=500, tol=1e-10):
+    ''' Fits a two component Gaussian mixture to values by expectation maximization
+
+        values: Samples as an array
+        iterations: Maximum number of EM iterations as an integer
+        tol: Change in mean log-likelihood below which EM stops
+
+        Components are ordered so the second one is the less likely, p <= 0.5,
+        with p the probability of the second component as in sample_k_slopes.
+
+        Returns: Mixture as (p, mean1, stdev1, mean2, stdev2)
+    '''
+
+    values = np.ravel(np.asarray(values, dtype=float))
+
+    if len(values) < 2:
+        raise ValueError('At least two values are needed to fit a mixture')
+
+    # the spread of the data keeps a collapsing component from reaching zero variance
+    floor = 1e-6 * (np.std(values) + 1e-12)
+
+    p = 0.5
+    means = np.percentile(values, [75, 25])
+    stdevs = np.full(2, np.std(values) / 2 + floor)
+    previous = -np.inf
+
+    for _ in range(iterations):
+        log_density = -0.5*((values[:, np.newaxis] - means)/stdevs)**2 - np.log(stdevs) - 0.5*np.log(2*np.pi)
+        log_joint = log_density + np.log([1 - p, p])
+
+        log_total = np.logaddexp(log_joint[:, 0], log_joint[:, 1])
+        responsibility = np.exp(log_joint - log_total[:, np.newaxis])
+
+        likelihood = log_total.mean()
+
+        if likelihood - previous < tol:
+            break
+
+        previous = likelihood
+
+        counts = responsibility.sum(axis=0)
+        p = np.clip(counts[1] / len(values), 1e-12, 1 - 1e-12)
+        means = responsibility.T @ values / counts
+        stdevs = np.sqrt(np.sum(responsibility * (values[:, np.newaxis] - means)**2, axis=0) / counts) + floor
+
+    if p > 0.5:
+        p = 1 - p
+        means = means[::-1]
+        stdevs = stdevs[::-1]
+
+    return float(p), float(means[0]), float(stdevs[0]), float(means[1]), float(stdevs[1])
+
+class PopulationFit:
+    ''' Class for estimating population Kslope and Vslope distributions from many patients' measurements '''
+
+    def __init__(self, therapy, doses, times, measurements, k_int, cl_cr, bw, measurement_variance=1):
+        ''' Creates PopulationFit object
+
+            therapy: Therapy giving the dosage period and length shared by every patient
+            doses: Dose given at each dosage interval to each patient as an array
+            times: Measurement times of each patient as a list of arrays
+            measurements: Measured concentrations of each patient as a list of arrays
+            k_int: Nonrenal elimination constant of each patient as a numeric value or an array
+            cl_cr: Creatinine clearance rate of each patient as a numeric value or an array
+            bw: Bodyweight of each patient as a numeric value or an array
+            measurement_variance: Variance of the measurement error as a numeric value
+
+            Histories of different lengths are padded to the longest one and masked.
+        '''
+
+        if len(times) != len(measurements):
+            raise ValueError('times and measurements need one history per patient')
+
+        n = len(times)
+        m = max([ len(history) for history in times ], default=0)
+
+        self.therapy = therapy
+        self.measurement_variance = measurement_variance
+
+        self.times = np.zeros((n, m))
+        self.measurements = np.zeros((n, m))
+        self.mask = np.zeros((n, m), dtype=bool)
+
+        for i, (t, y) in enumerate(zip(times, measurements)):
+            if len(t) != len(y):
+                raise ValueError('Patient {} has {} times and {} measurements'.format(i, len(t), len(y)))
+
+            self.times[i, :len(t)] = t
+            self.measurements[i, :len(y)] = y
+            self.mask[i, :len(t)] = True
+
+        if not np.all(self.mask.any(axis=1)):
+            raise ValueError('Every patient needs at least one measurement')
+
+        self.doses = np.broadcast_to(np.asarray(doses, dtype=float), (n,))
+        self.k_int = np.broadcast_to(np.asarray(k_int, dtype=float), (n,))
+        self.cl_cr = np.broadcast_to(np.asarray(cl_cr, dtype=float), (n,))
+        self.bw = np.broadcast_to(np.asarray(bw, dtype=float), (n,))
+
+    def __len__(self):
+        return len(self.times)
+
+    def predict(self, k_slopes, v_slopes, index=slice(None)):
+        ''' Noise-free concentrations at every measurement time and their gradients
+
+            k_slopes: Kslope of each patient in index, with any leading axes for multiple starts
+            v_slopes: Vslope of each patient in index, shaped like k_slopes
+            index: Patients to predict as a slice or an array of indices
+
+            Returns: 3-tuple of (..., n_patients, n_measurements) arrays where
+                     the first element holds the concentrations
+                     the second element holds their derivatives in Kslope
+                     the third element holds their derivatives in Vslope
+        '''
+
+        cl_cr = self.cl_cr[index]
+        bw = self.bw[index]
+
+        k_el = (self.k_int[index] + k_slopes * cl_cr)[..., np.newaxis]
+        v_d = (v_slopes * bw)[..., np.newaxis]
+        dose = self.doses[index][:, np.newaxis]
+
+        conc, _, conc_k, conc_v = concentration_gradient(self.times[index], dose, k_el, v_d, self.therapy.dosage_period, self.therapy.dosage_length)
+
+        return conc, conc_k * cl_cr[:, np.newaxis], conc_v * bw[:, np.newaxis]
+
+    def loss(self, conc, index=slice(None)):
+        ''' Half the sum of squared residuals of each patient's measurements
+
+            conc: Concentrations predicted for the patients in index, as returned by predict
+            index: Patients to score as a slice or an array of indices
+
+            Returns: (..., n_patients) array of losses
+        '''
+
+        return 0.5 * np.sum(np.where(self.mask[index], conc - self.measurements[index], 0)**2, axis=-1)
+
+    def fit_chunk(self, k_slopes, v_slopes, index, max_iter=50, tol=1e-6):
+        ''' Levenberg-Marquardt fit of every patient in index from every start at once
+
+            k_slopes: (n_starts, n_patients) array of starting Kslopes
+            v_slopes: (n_starts, n_patients) array of starting Vslopes
+
+            Each patient has two parameters, so the damped normal equations are solved
+            in closed form for all starts and patients together.
+
+            Returns: 3-tuple of (n_starts, n_patients) arrays of Kslopes, Vslopes and losses
+        '''
+
+        mask = self.mask[index]
+        y = self.measurements[index]
+
+        # elimination constant and volume of distribution are kept positive
+        k_min = (1e-6 - self.k_int[index]) / self.cl_cr[index]
+        v_min = 1e-6 / self.bw[index]
+
+        conc, conc_k, conc_v = self.predict(k_slopes, v_slopes, index)
+        loss = self.loss(conc, index)
+        damping = np.full(loss.shape, 1e-3)
+        converged = np.zeros(loss.shape, dtype=bool)
+
+        for _ in range(max_iter):
+            r = np.where(mask, conc - y, 0)
+            jk = np.where(mask, conc_k, 0)
+            jv = np.where(mask, conc_v, 0)
+
+            a = np.sum(jk*jk, axis=-1)
+            b = np.sum(jk*jv, axis=-1)
+            d = np.sum(jv*jv, axis=-1)
+            gk = np.sum(jk*r, axis=-1)
+            gv = np.sum(jv*r, axis=-1)
+
+            a_damped = a * (1 + damping)
+            d_damped = d * (1 + damping)
+            det = a_damped*d_damped - b*b
+            det = np.where(det > 0, det, np.inf)
+
+            trial_k = np.maximum(k_slopes - (d_damped*gk - b*gv) / det, k_min)
+            trial_v = np.maximum(v_slopes - (a_damped*gv - b*gk) / det, v_min)
+
+            trial = self.predict(trial_k, trial_v, index)
+            trial_loss = self.loss(trial[0], index)
+
+            # converged fits are frozen, only the others take steps
+            accepted = (trial_loss < loss) & ~converged
+            improvement = np.where(accepted, loss - trial_loss, 0)
+
+            k_slopes = np.where(accepted, trial_k, k_slopes)
+            v_slopes = np.where(accepted, trial_v, v_slopes)
+            conc, conc_k, conc_v = ( np.where(accepted[..., np.newaxis], new, old) for new, old in zip(trial, (conc, conc_k, conc_v)) )
+            loss = np.where(accepted, trial_loss, loss)
+            damping = np.where(converged, damping, np.clip(np.where(accepted, damping / 10, damping * 10), 1e-12, 1e12))
+
+            # a fit is done once its accepted steps stop improving or no damping helps any more
+            converged |= (accepted & (improvement <= tol * loss)) | (damping >= 1e12) | (loss <= tol)
+
+            if np.all(converged):
+                break
+
+        return k_slopes, v_slopes, loss / self.measurement_variance
+
+    def fit_patients(self, starts=8, seed=None, k_slope_range=(0.0005, 0.008), v_slope_range=(0.1, 0.5), max_iter=50, tol=1e-6, chunk_size=1024):
+        ''' Fits each patient's Kslope and Vslope from several starts and keeps the best
+
+            starts: Number of starting points per patient as an integer
+            seed: Seed of the starting points
+            k_slope_range: Interval the starting Kslopes are drawn from
+            v_slope_range: Interval the starting Vslopes are drawn from
+            max_iter: Maximum number of Levenberg-Marquardt iterations per chunk
+            tol: Relative improvement in loss below which a fit has converged
+            chunk_size: Number of patients fitted together
+
+            The first start of every patient is the middle of both ranges.
+
+            Returns: 3-tuple of (n_patients,) arrays of Kslopes, Vslopes and losses
+        '''
+
+        rng = np.random.default_rng(seed)
+        n = len(self)
+
+        k_starts = rng.uniform(*k_slope_range, (starts, n))
+        v_starts = rng.uniform(*v_slope_range, (starts, n))
+        k_starts[0] = np.mean(k_slope_range)
+        v_starts[0] = np.mean(v_slope_range)
+
+        k_slopes = np.empty(n)
+        v_slopes = np.empty(n)
+        losses = np.empty(n)
+
+        for start in range(0, n, chunk_size):
+            index = slice(start, min(start + chunk_size, n))
+            k, v, loss = self.fit_chunk(k_starts[:, index], v_starts[:, index], index, max_iter, tol)
+
+            best = np.argmin(loss, axis=0)
+            columns = np.arange(loss.shape[1])
+
+            k_slopes[index] = k[best, columns]
+            v_slopes[index] = v[best, columns]
+            losses[index] = loss[best, columns]
+
+        return k_slopes, v_slopes, losses
+
+    def fit_population(self, **kwargs):
+        ''' Fits every patient, then the population distributions of their estimates
+
+            Takes the keyword arguments of fit_patients.
+
+            Returns: 2-tuple where
+                     the first element is the Kslope mixture as (p, mean1, stdev1, mean2, stdev2),
+                     as consumed by sample_k_slopes
+                     the second element is the Vslope distribution as (mean, stdev),
+                     as consumed by sample_v_slopes
+        '''
+
+        k_slopes, v_slopes, _ = self.fit_patients(**kwargs)
+
+        return fit_mixture(k_slopes), (float(np.mean(v_slopes)), float(np.std(v_slopes)))
@@ -0,0 +1,108 @@
+import functools
+import json
+import time
+
+from contextlib import contextmanager
+from PKcontinuous import ParticlePosterior, PKSimulator, Prior
+
+# methods wrapped while profiling, the rest of the time the classes are untouched
+_hooks = {
+    PKSimulator: ('simulate', 'simulate_events', 'simulate_adaptive', 'administer', 'optimalDose', 'optimalInitialDose'),
+    Prior: ('kalman_filter',),
+    ParticlePosterior: ('kalman_filter',),
+}
+
+# methods whose number of simulated steps is counted
+_stepping = ('simulate', 'simulate_events', 'simulate_adaptive')
+
+_originals = {}
+
+class Profile:
+    ''' Class designed to aggregate call counts, wall time and simulated steps of one run '''
+
+    def __init__(self):
+        self.calls = {}
+        self.seconds = {}
+        self.steps = {}
+
+    def record(self, name, seconds, steps=0):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        self.seconds[name] = self.seconds.get(name, 0) + seconds
+        self.steps[name] = self.steps.get(name, 0) + steps
+
+    def as_dict(self):
+        ''' Returns the totals per hook; times include nested hooks, so they do not add up '''
+
+        return { name: {'calls': self.calls[name],
+                        'seconds': self.seconds[name],
+                        'steps': self.steps[name]} for name in sorted(self.calls) }
+
+    def to_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+def _wrap(name, method, profile):
+    counts_steps = name.split('.')[-1] in _stepping
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        before = self.n_steps if counts_steps else 0
+        start = time.perf_counter()
+
+        result = method(self, *args, **kwargs)
+
+        seconds = time.perf_counter() - start
+        steps = 0
+
+        if counts_steps:
+            # a reset hands back the finished trajectory and empties the buffers
+            after = len(result[0]) if result != None else self.n_steps
+            steps = after - before
+
+        profile.record(name, seconds, steps)
+
+        return result
+
+    return wrapper
+
+def enable(profile=None):
+    ''' Installs the hooks and returns the Profile they report to '''
+
+    if _originals:
+        raise RuntimeError('Profiling is already enabled')
+
+    profile = profile if profile != None else Profile()
+
+    for cls, names in _hooks.items():
+        for name in names:
+            method = cls.__dict__[name]
+            _originals[(cls, name)] = method
+            setattr(cls, name, _wrap('{}.{}'.format(cls.__name__, name), method, profile))
+
+    return profile
+
+def disable():
+    ''' Restores the original methods '''
+
+    for (cls, name), method in _originals.items():
+        setattr(cls, name, method)
+
+    _originals.clear()
+
+@contextmanager
+def profiled(profile=None):
+    ''' Profiles the enclosed block
+
+        with profiled() as profile:
+            simulator.simulate(step_size=0.1, stop_time=240, dose=simulator.dose)
+
+        print(profile.as_dict())
+    '''
+
+    profile = enable(profile)
+
+    try:
+        yield profile
+
+    finally:
+        disable()
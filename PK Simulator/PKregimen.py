@@ -0,0 +1,73 @@
+import numpy as np
+
+def regimen_grid(doses, periods, lengths):
+    ''' Every combination of candidate doses, dosage periods and dosage lengths
+
+        Returns: 3-tuple of flat arrays holding the dose, period and length of each regimen
+    '''
+
+    grid = np.meshgrid(np.asarray(doses, dtype=float), np.asarray(periods, dtype=float), np.asarray(lengths, dtype=float), indexing='ij')
+
+    return tuple( values.ravel() for values in grid )
+
+def evaluate_regimens(posterior, therapy, doses, periods, lengths, steady_state=True, trough_offset=1, chunk_size=1024):
+    ''' Expected peak/trough error of every candidate regimen over the posterior
+
+        posterior: Prior, ParticlePosterior or anything holding k_el, v_d and weights arrays
+        therapy: Therapy whose peak and trough goals are targeted
+        doses: Dose of each regimen as an array, in the units PKSimulator.simulate takes
+        periods: Dosage period in hours of each regimen as an array
+        lengths: Dosage length in hours of each regimen as an array
+        steady_state: Whether to score the steady state rather than the first dose
+        trough_offset: Hours before the next dose at which the trough is taken, as in optimalDose
+        chunk_size: Number of regimens evaluated against the whole posterior at once
+
+        The peak is taken at the end of the infusion. Regimens whose trough would fall
+        inside the infusion are scored inf.
+
+        Returns: Posterior expectation of (peak - goal)^2 + (trough - goal)^2 for each regimen as an array
+    '''
+
+    k_el = np.ravel(posterior.k_el)
+    v_d = np.ravel(posterior.v_d)
+    weights = np.ravel(posterior.weights)
+
+    doses, periods, lengths = np.broadcast_arrays(np.asarray(doses, dtype=float), np.asarray(periods, dtype=float), np.asarray(lengths, dtype=float))
+    errors = np.empty(doses.shape)
+
+    for start in range(0, doses.size, chunk_size):
+        stop = min(start + chunk_size, doses.size)
+
+        # regimens along the rows, posterior points along the columns
+        dose = doses.flat[start:stop][:, np.newaxis]
+        period = periods.flat[start:stop][:, np.newaxis]
+        length = lengths.flat[start:stop][:, np.newaxis]
+
+        peak = dose*(1-np.exp(-k_el*length))/(k_el*v_d)
+
+        if steady_state:
+            peak = peak/(1-np.exp(-k_el*period))
+
+        trough = peak*np.exp(-k_el*(period-trough_offset-length))
+
+        squared = (peak - therapy.peak)**2 + (trough - therapy.trough)**2
+        expected = squared @ weights
+
+        expected[np.ravel(period - trough_offset < length)] = np.inf
+        errors.flat[start:stop] = expected
+
+    return errors
+
+def best_regimen(posterior, therapy, doses, periods, lengths, **kwargs):
+    ''' Searches every combination of candidate doses, periods and lengths
+
+        Takes the keyword arguments of evaluate_regimens.
+
+        Returns: 4-tuple of the dose, period, length and expected error of the best regimen
+    '''
+
+    doses, periods, lengths = regimen_grid(doses, periods, lengths)
+    errors = evaluate_regimens(posterior, therapy, doses, periods, lengths, **kwargs)
+    best = np.argmin(errors)
+
+    return doses[best], periods[best], lengths[best], errors[best]
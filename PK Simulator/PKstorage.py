@@ -0,0 +1,166 @@
+import json
+import numpy as np
+import os
+
+class TrajectoryStore:
+    ''' Class designed to stream simulation outputs into chunked .npy files described by a manifest
+
+        The manifest is a log with one JSON line per chunk, so appending a chunk
+        costs the same however many chunks the store already holds.
+    '''
+
+    _manifest_name = 'manifest.jsonl'
+    # columns written together by append_simulation, one chunk per run
+    _run_columns = ('time_steps', 'amount_steps', 'concentration_steps', 'measurements', 'measurement_times', 'doses', 'weights')
+    # columns written together by append_cohort, one chunk per block of patients
+    _cohort_columns = ('cohort_time_steps', 'cohort_amounts', 'cohort_concentrations')
+
+    def __init__(self, path):
+        ''' Opens the store at path, creating the directory if needed
+
+            path: Directory holding the chunk files and manifest.jsonl
+        '''
+
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+        self.manifest = {'columns': {}}
+        # bytes of complete lines, a line cut short by a crash is dropped on the first append
+        self._log_size = 0
+        # the log is only opened by the first append, so a read-only store stays untouched
+        self._log = None
+
+        manifest = os.path.join(path, self._manifest_name)
+
+        if os.path.isfile(manifest):
+            with open(manifest, 'rb') as f:
+                lines = f.read().split(b'\n')
+
+            for line in lines[:-1]:
+                entry = json.loads(line)
+                self.manifest['columns'].setdefault(entry.pop('column'), []).append(entry)
+                self._log_size += len(line) + 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def columns(self):
+        return sorted(self.manifest['columns'])
+
+    def chunk_count(self, name):
+        return len(self.manifest['columns'].get(name, []))
+
+    def append(self, name, array):
+        ''' Writes array as the next chunk of column name and records it in the manifest
+
+            Returns: Index of the chunk within the column
+        '''
+
+        array = np.asarray(array)
+        chunks = self.manifest['columns'].setdefault(name, [])
+        filename = '{}.{:06d}.npy'.format(name, len(chunks))
+
+        np.save(os.path.join(self.path, filename), array)
+        entry = {'file': filename, 'shape': list(array.shape), 'dtype': array.dtype.str}
+        chunks.append(entry)
+
+        if self._log == None:
+            self._log = open(os.path.join(self.path, self._manifest_name), 'a')
+            self._log.truncate(self._log_size)
+
+        # the chunk is on disk before its line, so a reader never sees a missing file
+        self._log.write(json.dumps(dict(entry, column=name)) + '\n')
+        self._log.flush()
+
+        return len(chunks) - 1
+
+    def aligned_index(self, names):
+        ''' Next chunk index of columns written together, which must all have the same number of chunks '''
+
+        index = max([ self.chunk_count(name) for name in names ])
+
+        for name in names:
+            if self.chunk_count(name) != index:
+                raise ValueError('Column {} is not aligned with the other columns written with it'.format(name))
+
+        return index
+
+    def append_simulation(self, simulator, dose=None):
+        ''' Writes the trajectory, measurements, dose and prior weights of a PKSimulator run
+
+            Returns: Index of the run, which is the chunk index of each of its columns
+        '''
+
+        run = self.aligned_index(self._run_columns)
+
+        measurements = np.asarray(simulator.measurements, dtype=float)
+
+        self.append('time_steps', simulator.time_steps)
+        self.append('amount_steps', simulator.amount_steps)
+        self.append('concentration_steps', simulator.concentration_steps)
+        self.append('measurements', measurements)
+        self.append('measurement_times', np.asarray(simulator.therapy.measurement_times, dtype=float)[:len(measurements)])
+        self.append('doses', np.atleast_1d(np.asarray(simulator.dose if dose == None else dose, dtype=float)))
+        self.append('weights', simulator.priors.weights)
+
+        return run
+
+    def append_cohort(self, time_steps, amounts, concentrations):
+        ''' Writes a block of patients simulated together, as returned by simulate_cohort
+
+            time_steps: Time steps shared by the block as an array
+            amounts: (n_patients, n_steps) array of amounts
+            concentrations: (n_patients, n_steps) array of concentrations
+
+            Blocks are stacked along the patient axis by read, so a cohort larger than
+            memory can be written one block at a time and memory-mapped back per block.
+
+            Returns: Index of the block, which is the chunk index of each of its columns
+        '''
+
+        block = self.aligned_index(self._cohort_columns)
+
+        self.append('cohort_time_steps', time_steps)
+        self.append('cohort_amounts', np.atleast_2d(amounts))
+        self.append('cohort_concentrations', np.atleast_2d(concentrations))
+
+        return block
+
+    def load(self, name, chunk):
+        ''' Memory-maps one chunk of a column without reading it '''
+
+        entry = self.manifest['columns'][name][chunk]
+
+        return np.load(os.path.join(self.path, entry['file']), mmap_mode='r')
+
+    def chunks(self, name):
+        ''' Yields every chunk of a column memory-mapped, in the order they were written '''
+
+        for chunk in range(self.chunk_count(name)):
+            yield self.load(name, chunk)
+
+    def read(self, name):
+        ''' Reads a whole column into memory, stacking the chunks along the first axis '''
+
+        return np.concatenate([ np.atleast_1d(chunk) for chunk in self.chunks(name) ])
+
+    def run(self, index):
+        ''' Memory-maps every column of a run written by append_simulation as a dictionary '''
+
+        return { name: self.load(name, index) for name in self._run_columns }
+
+    def flush(self):
+        ''' Pushes the manifest lines written so far to the operating system '''
+
+        if self._log != None:
+            self._log.flush()
+
+    def close(self):
+        ''' Closes the manifest, which the next append opens again '''
+
+        if self._log != None:
+            self._log.close()
+            self._log = None
@@ -0,0 +1,200 @@
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from PKcontinuous import PatientBatch, find_time, sample_population
+
+class TrialSummary:
+    ''' Class designed to accumulate target attainment statistics without keeping trajectories '''
+
+    def __init__(self):
+        ''' Creates an empty TrialSummary object '''
+
+        self.patients = 0
+        self.peak_attained = 0
+        self.trough_attained = 0
+        self.attained = 0
+
+        # running mean and sum of squared deviations of each patient's mean peak and trough
+        self.peak_mean = 0
+        self.peak_m2 = 0
+        self.trough_mean = 0
+        self.trough_m2 = 0
+
+    def add(self, peaks, troughs, peak_goal, trough_goal):
+        ''' Adds a chunk of patients
+
+            peaks: (n_patients, n_doses) array of peak concentrations
+            troughs: (n_patients, n_doses) array of trough concentrations
+            peak_goal: Peak therapeutic goal in mg/L as a numeric value
+            trough_goal: Trough therapeutic goal in mg/L as a numeric value
+        '''
+
+        peak_ok = np.all(peaks <= peak_goal, axis=1)
+        trough_ok = np.all(troughs >= trough_goal, axis=1)
+
+        chunk = TrialSummary()
+        chunk.patients = len(peaks)
+        chunk.peak_attained = int(np.sum(peak_ok))
+        chunk.trough_attained = int(np.sum(trough_ok))
+        chunk.attained = int(np.sum(peak_ok & trough_ok))
+
+        mean_peaks = peaks.mean(axis=1)
+        mean_troughs = troughs.mean(axis=1)
+        chunk.peak_mean = mean_peaks.mean()
+        chunk.peak_m2 = np.sum((mean_peaks - chunk.peak_mean)**2)
+        chunk.trough_mean = mean_troughs.mean()
+        chunk.trough_m2 = np.sum((mean_troughs - chunk.trough_mean)**2)
+
+        self.merge(chunk)
+
+    def merge(self, other):
+        ''' Folds another summary into this one '''
+
+        total = self.patients + other.patients
+
+        if total == 0:
+            return
+
+        # pairwise update of the means and squared deviations
+        delta = other.peak_mean - self.peak_mean
+        self.peak_mean += delta * other.patients / total
+        self.peak_m2 += other.peak_m2 + delta**2 * self.patients * other.patients / total
+
+        delta = other.trough_mean - self.trough_mean
+        self.trough_mean += delta * other.patients / total
+        self.trough_m2 += other.trough_m2 + delta**2 * self.patients * other.patients / total
+
+        self.patients = total
+        self.peak_attained += other.peak_attained
+        self.trough_attained += other.trough_attained
+        self.attained += other.attained
+
+    def as_dict(self):
+        ''' Returns the attainment fractions and peak/trough statistics '''
+
+        n = max(self.patients, 1)
+
+        return {
+            'patients': self.patients,
+            'attainment': self.attained / n,
+            'peak_attainment': self.peak_attained / n,
+            'trough_attainment': self.trough_attained / n,
+            'peak_mean': float(self.peak_mean),
+            'peak_stdev': float(np.sqrt(self.peak_m2 / n)),
+            'trough_mean': float(self.trough_mean),
+            'trough_stdev': float(np.sqrt(self.trough_m2 / n)),
+        }
+
+class VirtualTrial:
+    ''' Class for running Monte Carlo virtual trials of a dosing regimen '''
+
+    def __init__(self, simulator, dose, k_slope_params, v_slope_params, stop_time=None, step_size=0.1):
+        ''' Creates VirtualTrial object
+
+            simulator: PKSimulator whose patient, errors and therapy define the trial
+            dose: Dose given at each dosage interval as a numeric value
+            k_slope_params: Population Kslope mixture as (p, mean1, stdev1, mean2, stdev2),
+                            as consumed by sample_k_slopes
+            v_slope_params: Population Vslope distribution as (mean, stdev),
+                            as consumed by sample_v_slopes
+            stop_time: Time in hours at which each simulation stops, defaults to the therapy duration
+            step_size: Length in hours of each step as a numeric value
+        '''
+
+        self.simulator = simulator
+        self.dose = dose
+        self.k_slope_params = k_slope_params
+        self.v_slope_params = v_slope_params
+        self.stop_time = stop_time if stop_time != None else simulator.therapy.duration
+        self.step_size = step_size
+
+    def sample_patients(self, rng, num):
+        ''' Draws the elimination constant and volume of distribution of num patients, as in sample_population '''
+
+        k_slopes, v_slopes = sample_population(rng, num, self.k_slope_params, self.v_slope_params)
+
+        patient = self.simulator.patient
+        patients = PatientBatch(k_slopes, patient.k_int, patient.cl_cr, v_slopes, patient.bw)
+
+        return patients.k_el, patients.v_d
+
+    def peak_trough_indices(self, time_steps):
+        ''' Indices of every peak and trough time reached before the stop time '''
+
+        therapy = self.simulator.therapy
+        starts = np.arange(0, self.stop_time, therapy.dosage_period)
+        starts = starts[starts + therapy.dosage_period - 1 <= self.stop_time]
+
+        peaks = [ find_time(time_steps, round(t + therapy.dosage_length, 10)) for t in starts ]
+        troughs = [ find_time(time_steps, round(t + therapy.dosage_period - 1, 10)) for t in starts ]
+
+        return peaks, troughs
+
+    def run_chunk(self, seed, num, trajectories=False):
+        ''' Simulates num patients from one seed and summarizes them
+
+            trajectories: Whether to also return the output of simulate_cohort
+
+            Returns: TrialSummary of the patients, paired with their trajectories if asked for
+        '''
+
+        rng = np.random.default_rng(seed)
+        k_el, v_d = self.sample_patients(rng, num)
+        seeds = rng.integers(0, 2**32 - 1, num)
+
+        ts, ys, zs = self.simulator.simulate_cohort(self.step_size, self.stop_time, self.dose, k_el, v_d, seeds)
+        peaks, troughs = self.peak_trough_indices(ts)
+
+        summary = TrialSummary()
+        summary.add(zs[:, peaks], zs[:, troughs], self.simulator.therapy.peak, self.simulator.therapy.trough)
+
+        if trajectories:
+            return summary, (ts, ys, zs)
+
+        return summary
+
+    def run(self, n_patients, seed=None, chunk_size=256, workers=None, store=None):
+        ''' Runs the trial across a process pool
+
+            n_patients: Number of simulated patients as an integer
+            seed: Seed of the trial as an integer or a np.random.SeedSequence
+            chunk_size: Number of patients simulated together by a worker
+            workers: Number of worker processes, defaults to the number of cores
+            store: TrajectoryStore every chunk's trajectories are appended to with append_cohort,
+                   in order, so only the chunks in flight are held in memory
+
+            Each chunk gets its own SeedSequence child and chunks are reduced in order,
+            so the summary does not depend on the number of workers.
+
+            Returns: TrialSummary of every patient
+        '''
+
+        root = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        sizes = [ min(chunk_size, n_patients - start) for start in range(0, n_patients, chunk_size) ]
+        seeds = root.spawn(len(sizes))
+
+        summary = TrialSummary()
+        trajectories = store != None
+
+        if workers == 1:
+            chunks = ( self.run_chunk(child, num, trajectories) for child, num in zip(seeds, sizes) )
+            return self.reduce(chunks, summary, store)
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunks = executor.map(_run_chunk, [self] * len(sizes), seeds, sizes, [trajectories] * len(sizes))
+            return self.reduce(chunks, summary, store)
+
+    def reduce(self, chunks, summary, store=None):
+        ''' Merges the chunks into summary in order, writing their trajectories to store if given '''
+
+        for chunk in chunks:
+            if store != None:
+                chunk, trajectories = chunk
+                store.append_cohort(*trajectories)
+
+            summary.merge(chunk)
+
+        return summary
+
+def _run_chunk(trial, seed, num, trajectories=False):
+    return trial.run_chunk(seed, num, trajectories)
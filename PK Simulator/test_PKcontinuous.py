@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from PKcontinuous import ErrorTypes, PKSimulator, Patient, Prior, Therapy, check_gradients, concentration_gradient
+
+# times at and around infusion boundaries, where the piecewise solution switches
+times = np.array([0.5, 1, 11, 12, 30.3, 73, 155.9])
+
+def make_simulator():
+    patient = Patient(0.003125, 0.01, 50, 0.2806, 70)
+    prior = Prior([0.002, 0.003, 0.004], [0.25, 0.28, 0.31], patient)
+    therapy = Therapy(240, 12, 1, [1, 11, 73, 83], 7, 1.5)
+
+    return PKSimulator(patient, prior, ErrorTypes(0, 0, 0, 0), therapy, seed=0)
+
+@pytest.mark.parametrize('t', [1.0, 12.0, 83.5])
+def test_gradients_scalar(t):
+    gaps = check_gradients(t, 150, 0.16625, 19.642, 12, 1)
+
+    assert max(gaps.values()) < 1e-6, gaps
+
+def test_gradients_batched_k_el():
+    k_el = np.linspace(0.05, 0.5, 6)[:, np.newaxis]
+    gaps = check_gradients(times, 200, k_el, 20, 12, 1)
+
+    assert max(gaps.values()) < 1e-6, gaps
+
+def test_laplace_posterior_defaults_times():
+    simulator = make_simulator()
+    patient = simulator.patient
+    measurements = concentration_gradient(np.array([1., 11, 73, 83]), 200, patient.k_el, patient.v_d, 12, 1)[0]
+
+    mode, covariance = simulator.laplacePosterior(measurements=measurements, dose=200, measurement_variance=0.01)
+
+    assert mode == pytest.approx([patient.k_slope, patient.v_slope], rel=0.05)
+    assert covariance.shape == (2, 2)
+
+def test_laplace_posterior_rejects_mismatched_times():
+    simulator = make_simulator()
+
+    with pytest.raises(ValueError):
+        simulator.laplacePosterior([1, 11], [7.0], dose=200)
+
+def test_newton_dose_requires_times_and_goals_together():
+    simulator = make_simulator()
+
+    with pytest.raises(ValueError):
+        simulator.newtonDose(times=[1, 11])
+
+    with pytest.raises(ValueError):
+        simulator.newtonDose(goals=[7, 1.5])
+
+def test_newton_dose_matches_closed_form():
+    simulator = make_simulator()
+    patient = simulator.patient
+
+    dose = simulator.newtonDose([1, 11], [7, 1.5], patient=patient)
+
+    assert dose == pytest.approx(simulator.optimalDoses(patient.k_el, patient.v_d))